@@ -0,0 +1,63 @@
+"""
+Measure handling a 5,000-user netsplit as separate QUIT messages against
+handling it as one IRCv3 netsplit batch, with a few application handlers
+that each log the QUITs they see. State tracking still sees every QUIT in
+both cases. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/batch.py
+"""
+
+from fakes import NullConnection
+from irc2 import client, parser
+import asyncio
+import time
+
+USERS = 5000
+HANDLERS = 5
+
+def make_client():
+    irc = client.IRCClient(NullConnection())
+    irc.nick = "me"
+    calls = [0]
+    log = []
+
+    async def on_quit(message):
+        calls[0] += 1
+        log.append("{} has quit ({})".format(message.prefix.nick, message.args[-1]))
+
+    async def on_netsplit(servers, users):
+        calls[0] += 1
+        log.append("Netsplit between {}: {} users quit".format(" and ".join(servers), len(users)))
+
+    for _ in range(HANDLERS):
+        irc.subscribe(parser.Message(verb="QUIT"), on_quit)
+    irc.event.subscribe("netsplit", on_netsplit)
+    return irc, calls
+
+async def run(lines):
+    irc, calls = make_client()
+    nicks = " ".join("user{}".format(n) for n in range(USERS))
+    for line in (":me!u@h JOIN #chan", ":srv 353 me = #chan :me " + nicks):
+        await irc._run_handlers(parser.parse_line(line))
+
+    lines = [parser.parse_line(line) for line in lines]
+    start = time.perf_counter()
+    for line in lines:
+        await irc._run_handlers(line)
+    if irc._handler_task is not None:
+        await irc._handler_task
+    return time.perf_counter() - start, calls[0]
+
+def main():
+    quits = [":user{}!u@h QUIT :hub.example leaf.example".format(n) for n in range(USERS)]
+    batched = ([":srv BATCH +split netsplit hub.example leaf.example"] +
+               ["@batch=split " + line for line in quits] +
+               [":srv BATCH -split"])
+
+    loop = asyncio.new_event_loop()
+    for name, lines in (("separate QUITs", quits), ("netsplit batch", batched)):
+        elapsed, calls = loop.run_until_complete(run(lines))
+        print("{:<15} {:.1f}ms, {} application handler calls".format(name, elapsed * 1000, calls))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Stand-ins for connections and the event loop, shared by the benchmarks.
+They throw away whatever is written to them, so that only irc2's own work
+is measured.
+"""
+
+from irc2.ircd.client import Client
+from irc2.ircd.handler import handler
+
+class NullWriter(object):
+    """
+    A StreamWriter for ircd clients which counts the bytes written to it.
+    It has no transport, so nothing is ever buffered.
+    """
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 0)
+
+class NullLoop(object):
+    def create_task(self, coro):
+        coro.close()
+
+class NullManager(object):
+    loop = NullLoop()
+
+def make_ircd_client(n):
+    """
+    Make an ircd Client named "user<n>", connected to nothing.
+    """
+    client = Client(None, NullWriter(), NullManager(), handler)
+    client.data["nickname"] = "user{}".format(n)
+    client.data["ident"] = "user"
+    return client
+
+class NullConnection(object):
+    """
+    An IRCConnection for IRCClients which sends nothing.
+    """
+    callback = None
+    host = "null"
+    reading_paused = False
+
+    def send(self, *args, tags=None):
+        pass
+
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        self.reading_paused = False
@@ -0,0 +1,44 @@
+"""
+Measure ircd channel fan-out to 10k members: sending a PRIVMSG to each
+member separately (formatting and encoding it once per member, as
+Channel.send_except used to) against Channel.send_except, which encodes it
+once. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/ircd_fanout.py
+"""
+
+from fakes import make_ircd_client
+from irc2.ircd.channel import Channel
+import logging
+import time
+
+MEMBERS = 10000
+MESSAGES = 20
+
+def legacy_send_except(channel, exc, prefix, *data):
+    for member in channel.members:
+        if member != exc:
+            data_list = list(data)
+            data_list.insert(0, ":{}".format(prefix))
+            line = (" ".join(data_list[:-1]) + " :" + data_list[-1] + "\r\n").encode()
+            logging.getLogger("irc2.ircd.handler").debug("Sent raw {}".format(line))
+            member.write(line)
+
+def main():
+    channel = Channel("#bench")
+    for n in range(MEMBERS):
+        channel.members[make_ircd_client(n)] = ""
+    sender = next(iter(channel.members))
+    text = "hello there, this is a message of a fairly typical length for a channel"
+
+    for name, send in (("per-member encode", lambda *data: legacy_send_except(channel, sender, *data)),
+                       ("encode once", lambda *data: channel.send_except(sender, *data))):
+        start = time.perf_counter()
+        for _ in range(MESSAGES):
+            send("user0!user@host", "PRIVMSG", "#bench", text)
+        elapsed = time.perf_counter() - start
+        lines = MESSAGES * (MEMBERS - 1)
+        print("{:<18} {} lines in {:.3f}s ({:.0f} lines/s)".format(name, lines, elapsed, lines / elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Measure 10k clients joining one ircd channel in turn, each receiving the
+NAMES reply: sorting the members and chunking the reply from scratch on
+every join (as Channel.add used to) against Channel.add with its sorted,
+cached NAMES chunks. Both also send each JOIN to every member, which is
+most of what remains of the second time. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/ircd_names.py
+"""
+
+from fakes import make_ircd_client
+from irc2.ircd.channel import Channel
+from irc2.ircd.handler import handler
+from irc2.ircd.numerics import *
+from irc2.ircd import utils
+from irc2.utils import join_max_length
+import time
+
+JOINS = 10000
+
+class LegacyChannel(Channel):
+    def add(self, client):
+        client.data["channels"].add(self)
+        self.members[client] = "" if self.members else "o"
+        self.send(client.hostmask(), "JOIN", self.name)
+
+        names = [(utils.prefixes[value[0]] if value else "") + key.data["nickname"]
+                 for key, value in
+                    sorted(self.members.items(), key=lambda k: k[0].data["nickname"])]
+
+        while names:
+            cur, names = join_max_length(names, " ")
+            client.send_numeric(RPL_NAMREPLY, "=", self.name, cur)
+        client.send_numeric(RPL_ENDOFNAMES, self.name, "End of NAMES list.")
+
+def main():
+    handler.config["sendq_hard"] = float("inf")
+    for name, cls in (("sort every join", LegacyChannel), ("sorted + cached", Channel)):
+        clients = [make_ircd_client(n) for n in range(JOINS)]
+        channel = cls("#bench")
+        channel.topic = None
+        start = time.perf_counter()
+        for client in clients:
+            channel.add(client)
+        elapsed = time.perf_counter() - start
+        print("{:<16} {} joins in {:.2f}s".format(name, JOINS, elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Measure sending NICK to the neighbors of a user in 50 channels of 1k
+members each (with members overlapping between channels): deduplicating
+recipients by building the union of every channel's members (as
+Client.all_channel_clients used to) against Client.all_channel_clients,
+which marks recipients with a generation stamp instead. Reports the time
+taken to find the recipients of a NICK, to send it, and the memory
+allocated while finding its recipients. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/ircd_neighbors.py
+"""
+
+from fakes import make_ircd_client
+from irc2.ircd.client import Client
+from irc2.ircd.channel import Channel
+from irc2.ircd.handler import handler
+import random
+import time
+import tracemalloc
+
+CHANNELS = 50
+MEMBERS = 1000
+USERS = 20000
+EVENTS = 200
+
+def legacy_channel_clients(client):
+    result = set()
+    for chan in client.data["channels"]:
+        result |= set(chan.members.keys())
+    return result
+
+def main():
+    random.seed(0)
+    users = [make_ircd_client(n) for n in range(USERS)]
+    subject = users[0]
+    for n in range(CHANNELS):
+        channel = Channel("#chan{}".format(n))
+        for member in [subject] + random.sample(users[1:], MEMBERS - 1):
+            member.data["channels"].add(channel)
+            channel.members[member] = ""
+
+    recipients = len(legacy_channel_clients(subject))
+    methods = (("set union", legacy_channel_clients),
+               ("generation stamp", Client.all_channel_clients))
+
+    # alternate between the methods, so that they run in the same conditions
+    find, send = [0, 0], [0, 0]
+    for _ in range(EVENTS):
+        for n, (_, neighbors) in enumerate(methods):
+            start = time.perf_counter()
+            for _ in neighbors(subject):
+                pass
+            find[n] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            handler.broadcast(neighbors(subject), subject.hostmask(), "NICK", "newnick")
+            send[n] += time.perf_counter() - start
+
+    for n, (name, neighbors) in enumerate(methods):
+        tracemalloc.start()
+        for _ in neighbors(subject):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print("{:<17} {} unique recipients: found in {:.2f}ms, NICK sent in {:.2f}ms, {:.0f} KiB allocated".format(
+            name, recipients, find[n] / EVENTS * 1000, send[n] / EVENTS * 1000, peak / 1024))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Compare IStr hashing and equality against the previous implementation,
+which casefolded with four str.replace passes on every call. Run from the
+repository root:
+
+    PYTHONPATH=. python benchmarks/istr.py
+"""
+
+from irc2.utils import IDict, IStr
+import random
+import string
+import timeit
+
+class LegacyIStr(str):
+    case_map = list(zip("[]\\~", "{}|^"))
+
+    def lower(self):
+        s = str.lower(self)
+        for lo, up in LegacyIStr.case_map:
+            s = s.replace(up, lo)
+        return LegacyIStr(s)
+
+    def __hash__(self):
+        return hash(str(self.lower()))
+
+    def __eq__(self, other):
+        if not isinstance(other, LegacyIStr):
+            other = LegacyIStr(other)
+        return str(self.lower()) == str(other.lower())
+
+def words(n, prefix="", length=9):
+    rng = random.Random(n)
+    chars = string.ascii_letters + "[]\\`_^{|}"
+    return [prefix + "".join(rng.choice(chars) for _ in range(length)) for _ in range(n)]
+
+def run(name, stmt, ops):
+    best = min(timeit.repeat(stmt, number=1, repeat=5))
+    print("{:<40} {:>12.0f} ops/sec".format(name, ops / best))
+
+def main():
+    workloads = (("nicks", words(5000)), ("channels", words(5000, "#", 14)))
+    for label, cls in (("legacy", LegacyIStr), ("cached", IStr)):
+        for kind, data in workloads:
+            items = [cls(item) for item in data]
+            probes = [cls(item.swapcase()) for item in data]
+            table = {item: True for item in items}
+            run("{} hash {}".format(label, kind), lambda: [hash(i) for i in items], len(items))
+            run("{} eq {}".format(label, kind), lambda: [a == b for a, b in zip(items, probes)], len(items))
+            run("{} dict lookup {}".format(label, kind), lambda: [p in table for p in probes], len(probes))
+
+    idict = IDict({nick: True for nick in workloads[0][1]})
+    probes = [IStr(nick.upper()) for nick in workloads[0][1]]
+    run("IDict lookup nicks", lambda: [idict[p] for p in probes], len(probes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Compare Message.matches against compiled patterns (Message.compile). Run from
+the repository root:
+
+    PYTHONPATH=. python benchmarks/match.py
+"""
+
+from irc2.parser import Message, parse_line
+import timeit
+
+LINES = [parse_line(line) for line in (
+    b":nick!ident@host PRIVMSG #channel :hello there",
+    b":nick!ident@host NOTICE nick2 :hi",
+    b":nick!ident@host JOIN #channel",
+    b":irc.example.com 001 me :Welcome",
+    b"@account=nick :nick!ident@host PRIVMSG #other :tagged",
+)]
+
+PATTERNS = {
+    "any": Message(),
+    "verb": Message(verb="PRIVMSG"),
+    "verb list": Message(verb=["902", "903", "904"]),
+    "verb + channel": Message(verb="PRIVMSG", args=["#channel"]),
+    "tag": Message(tags={"account": None}),
+}
+
+def run(name, stmt, ops):
+    best = min(timeit.repeat(stmt, number=2000, repeat=5))
+    print("{:<32} {:>12.0f} matches/sec".format(name, ops * 2000 / best))
+
+def main():
+    for line in LINES:
+        line.verb, line.args, line.tags, line.prefix
+
+    for name, pat in PATTERNS.items():
+        match = pat.compile()
+        run("matches  " + name, lambda: [pat.matches(line) for line in LINES], len(LINES))
+        run("compiled " + name, lambda: [match(line) for line in LINES], len(LINES))
+
+if __name__ == '__main__':
+    main()
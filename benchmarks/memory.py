@@ -0,0 +1,52 @@
+"""
+Measure the memory used per retained Message for a representative capture,
+as a message history buffer would keep them. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/memory.py
+"""
+
+from irc2 import parser
+import random
+import tracemalloc
+
+def capture(n):
+    rng = random.Random(0)
+    words = ["hello", "there", "what", "is", "going", "on", "in", "#channel", "today", "lol"]
+    lines = []
+    for idx in range(n):
+        nick = "user{}".format(rng.randrange(2000))
+        kind = rng.random()
+        if kind < 0.7:
+            text = " ".join(rng.choice(words) for _ in range(rng.randrange(3, 20)))
+            lines.append("@time=2016-01-01T00:00:00.000Z;msgid=m{} :{}!{}@host-{}.example.com PRIVMSG #channel :{}".format(
+                idx, nick, nick, idx % 500, text))
+        elif kind < 0.85:
+            lines.append(":{}!{}@host.example.com JOIN #channel".format(nick, nick))
+        elif kind < 0.95:
+            lines.append(":{}!{}@host.example.com QUIT :Quit: leaving".format(nick, nick))
+        else:
+            lines.append(":irc.example.com 353 me = #channel :@op +voice {}".format(nick))
+    return [line.encode() + b"\r\n" for line in lines]
+
+def measure(name, parse, lines, touch=False):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [parse(line) for line in lines]
+    if touch:
+        for message in messages:
+            message.verb, message.args, message.prefix.nick
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("{:<36} {:>8.0f} bytes/message".format(name, used / len(messages)))
+    return messages
+
+def main():
+    lines = capture(50000)
+    print("average raw line: {:.0f} bytes".format(sum(map(len, lines)) / len(lines)))
+    measure("parse_line_eager", parser.parse_line_eager, lines)
+    measure("parse_line_eager, fields accessed", parser.parse_line_eager, lines, touch=True)
+    measure("parse_line", parser.parse_line, lines)
+    measure("parse_line, fields accessed", parser.parse_line, lines, touch=True)
+
+if __name__ == '__main__':
+    main()
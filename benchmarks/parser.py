@@ -0,0 +1,36 @@
+"""
+Compare parse_line against parse_line_eager. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/parser.py
+"""
+
+from irc2 import parser
+from irc2.utils import IStr
+import timeit
+
+LINES = [
+    b":nick!ident@host.example.com PRIVMSG #channel :hello there, how is everyone doing today?\r\n",
+    b"@time=2016-01-01T00:00:00.000Z;account=nick :nick!ident@host.example.com PRIVMSG #channel :tagged\r\n",
+    b":irc.example.com 353 me = #channel :@op +voice nick1 nick2 nick3 nick4 nick5\r\n",
+    b":nick!ident@host.example.com JOIN #channel\r\n",
+    b"PING :irc.example.com\r\n",
+]
+
+# like IRCClient's dispatch cache, which is keyed by verb
+HANDLERS = {IStr(verb): [] for verb in ("PRIVMSG", "353", "JOIN", "PING")}
+
+def run(name, stmt, number=20000):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print("{:<28} {:>10.0f} lines/sec".format(name, number * len(LINES) / best))
+
+def main():
+    for label, f in (("eager", parser.parse_line_eager), ("lazy", parser.parse_line)):
+        run(label + " parse only", lambda: [f(line) for line in LINES])
+        run(label + " parse + verb", lambda: [f(line).verb for line in LINES])
+        run(label + " parse + all fields",
+            lambda: [(m.tags, m.prefix, m.verb, m.args) for m in map(f, LINES)])
+        run(label + " parse + dispatch",
+            lambda: [(HANDLERS.get(m.verb), m.args, m.prefix) for m in map(f, LINES)])
+
+if __name__ == '__main__':
+    main()
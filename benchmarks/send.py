@@ -0,0 +1,60 @@
+"""
+Compare the previous IRCConnection.send (re-parse for logging, one write per
+line) against the current coalescing pipeline, for a burst of lines like the
+ones say() produces. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/send.py
+"""
+
+from irc2 import connection, parser
+import asyncio
+import logging
+import time
+
+class CountingWriter(object):
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+    async def drain(self):
+        pass
+
+def legacy_send(writer, *args):
+    line = (" ".join(args[:-1]) + " :" + args[-1]).encode()
+    if not line.endswith(b"\n"):
+        line = line + b"\n"
+    logging.info("Send: {}".format(parser.parse_line(line)))
+    writer.write(line)
+
+async def burst(send, lines, bursts):
+    for _ in range(bursts):
+        for text in lines:
+            send("PRIVMSG", "#channel", text)
+        await asyncio.sleep(0)
+
+def run(name, send, writer, lines, bursts=2000):
+    start = time.perf_counter()
+    asyncio.run(burst(send, lines, bursts))
+    elapsed = time.perf_counter() - start
+    print("{:<10} {:>10.0f} lines/sec {:>8} writes {:>10} bytes".format(
+        name, bursts * len(lines) / elapsed, writer.writes, writer.bytes))
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    lines = ["word " * 70] * 8
+
+    writer = CountingWriter()
+    run("legacy", lambda *args: legacy_send(writer, *args), writer, lines)
+
+    conn = connection.IRCConnection()
+    conn.writer = CountingWriter()
+    # flush only writes to a connected socket
+    conn.connected = True
+    run("pipeline", conn.send, conn.writer, lines)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Run clients under ShardedRuntime against the bundled irc2.ircd (started as a
+subprocess) and measure how many forwarded events per second the runtime
+handles with one worker and with several. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/shard.py
+"""
+
+from irc2 import shard
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+CLIENTS = 20
+MESSAGES = 50
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_for_server(port):
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+async def run(port, workers):
+    runtime = shard.ShardedRuntime(workers=workers, stagger=0.01)
+    for n in range(CLIENTS):
+        conf = runtime.add("127.0.0.1", port, ssl=False)
+        conf.register("w{}bench{}".format(workers, n), "bench", "bench")
+        conf.join("#bench{}".format(workers))
+
+    ready = asyncio.Event()
+    done = asyncio.Event()
+    counts = {"ready": 0, "message": 0}
+    expected = CLIENTS * MESSAGES * (CLIENTS - 1)
+
+    @runtime.event.ready
+    async def on_ready(client):
+        counts["ready"] += 1
+        if counts["ready"] == CLIENTS:
+            ready.set()
+
+    @runtime.event.message
+    async def on_message(client, message, prefix, target, text):
+        counts["message"] += 1
+        if counts["message"] == expected:
+            done.set()
+
+    await runtime.start()
+    await ready.wait()
+
+    start = time.perf_counter()
+    channel = "#bench{}".format(workers)
+    for n in range(MESSAGES):
+        for client in runtime.clients:
+            # bypass the per-client rate limit, which would dominate
+            client.irc.send("PRIVMSG", channel, "message {}".format(n))
+    await asyncio.wait_for(done.wait(), 120)
+    elapsed = time.perf_counter() - start
+
+    await runtime.stop()
+    return elapsed
+
+def main():
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "-m", "irc2.ircd.ircd",
+                               "--port", str(port), "--log-level", "ERROR",
+                               "--flood-burst", str(10 ** 6)])
+    try:
+        asyncio.run(wait_for_server(port))
+        events = CLIENTS * MESSAGES * (CLIENTS - 1)
+        for workers in (1, max(2, min(4, os.cpu_count() or 1))):
+            elapsed = asyncio.run(run(port, workers))
+            print("{} worker(s): {} events in {:.2f}s ({:.0f} events/s)".format(
+                workers, events, elapsed, events / elapsed))
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Measure IRCState memory use per channel member and the cost of NICK and QUIT
+updates with 100k users. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/state.py
+"""
+
+from fakes import NullConnection
+from irc2 import client, parser
+import asyncio
+import time
+import tracemalloc
+
+USERS = 100000
+CHANNELS = 50
+
+async def feed(c, lines):
+    for line in lines:
+        await c._run_handlers(line)
+
+def timed(c, name, lines):
+    start = time.perf_counter()
+    asyncio.run(feed(c, lines))
+    elapsed = time.perf_counter() - start
+    print("{:<8} {:>10.0f} updates/sec".format(name, len(lines) / elapsed))
+
+def main():
+    c = client.IRCClient(NullConnection())
+    c.nick = "me"
+
+    joins = [parser.parse_line(":me!me@host JOIN #channel{}".format(n).encode()) for n in range(CHANNELS)]
+    names = [parser.parse_line(":irc.example.com 353 me = #channel{} :{}".format(
+                 n % CHANNELS, " ".join("+user{}".format(u) for u in range(n, USERS, 250))).encode())
+             for n in range(250)]
+    asyncio.run(feed(c, joins))
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    asyncio.run(feed(c, names))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    members = sum(len(channel.members) for channel in c.state.channels.values())
+    print("{} users, {} memberships, {:.0f} bytes per member".format(len(c.state.users), members, used / members))
+
+    nicks = [parser.parse_line(":user{0}!u@h NICK renamed{0}".format(u).encode()) for u in range(USERS)]
+    quits = [parser.parse_line(":renamed{0}!u@h QUIT :bye".format(u).encode()) for u in range(USERS)]
+    timed(c, "NICK", nicks)
+    timed(c, "QUIT", quits)
+
+if __name__ == '__main__':
+    main()
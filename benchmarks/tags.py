@@ -0,0 +1,51 @@
+"""
+Measure parse throughput on tag-heavy lines (server-time, msgid, account-tag
+and batch), comparing the previous eager IStr-keyed tag parsing against the
+lazy Tags view. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/tags.py
+"""
+
+from irc2 import parser
+from irc2.utils import IStr
+import timeit
+
+LINES = [
+    b"@time=2016-01-01T00:00:00.000Z;msgid=Yb6cRTLiVcbd7sEqrvgHcz;account=alice;batch=ab12 "
+    b":alice!alice@host.example.com PRIVMSG #channel :hello there",
+    b"@time=2016-01-01T00:00:01.000Z;msgid=vsSJDPNfhh5cxSBYZBR5W8;account=bob "
+    b":bob!bob@host.example.com PRIVMSG #channel :reply",
+    b"@time=2016-01-01T00:00:02.000Z;msgid=x7p2k;+draft/reply=Yb6cRTLiVcbd7sEqrvgHcz;label=a\\sb "
+    b":carol!carol@host.example.com NOTICE #channel :escaped",
+    b":irc.example.com PING :untagged",
+]
+
+def legacy_parse_tags(tagstr):
+    tags = {}
+    for item in tagstr[1:].split(";"):
+        if "=" in item:
+            key, value = item.split("=", maxsplit=1)
+            tags[IStr(key)] = IStr(value)
+        else:
+            tags[IStr(item)] = True
+    return tags
+
+def legacy_tags(line):
+    line = line.decode("utf-8")
+    if line.startswith("@"):
+        return legacy_parse_tags(line.split(" ", maxsplit=1)[0])
+    return {}
+
+def run(name, stmt, number=20000):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print("{:<28} {:>10.0f} lines/sec".format(name, number * len(LINES) / best))
+
+def main():
+    run("eager tags", lambda: [legacy_tags(line) for line in LINES])
+    run("eager tags + time", lambda: [legacy_tags(line).get("time") for line in LINES])
+    run("lazy tags", lambda: [parser.parse_line(line).tags for line in LINES])
+    run("lazy tags + time", lambda: [parser.parse_line(line).tags.get("time") for line in LINES])
+    run("lazy tags + all values", lambda: [dict(parser.parse_line(line).tags) for line in LINES])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Compare reading lines with StreamReader.readline against reading batches
+from transport.LineProtocol, over a loopback TCP connection, both with and
+without parsing each line. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/transport.py
+"""
+
+from irc2 import parser, transport
+import asyncio
+import time
+
+LINES = 200000
+LINE = b"@time=2016-01-01T00:00:00.000Z :nick!user@host PRIVMSG #channel :hello there, how are you?\r\n"
+
+async def serve(reader, writer):
+    chunk = LINE * 1000
+    for _ in range(LINES // 1000):
+        writer.write(chunk)
+        await writer.drain()
+    writer.close()
+
+async def read_stream(port, parse):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    count = 0
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if parse:
+            parser.parse_line(line).verb
+        count += 1
+    writer.close()
+    return count
+
+async def read_protocol(port, parse):
+    loop = asyncio.get_event_loop()
+    _, protocol = await loop.create_connection(transport.LineProtocol, "127.0.0.1", port)
+    count = 0
+    while True:
+        lines = await protocol.read_lines()
+        if not lines:
+            break
+        if parse:
+            for line in lines:
+                parser.parse_line(line).verb
+        count += len(lines)
+    protocol.close()
+    return count
+
+async def main():
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    for parse in (False, True):
+        for name, read in (("StreamReader.readline", read_stream), ("LineProtocol", read_protocol)):
+            start = time.perf_counter()
+            count = await read(port, parse)
+            elapsed = time.perf_counter() - start
+            print("{:<22} {:<13} {} lines in {:.3f}s ({:.0f} lines/s)".format(
+                name, "(parsed)" if parse else "(split only)", count, elapsed, count / elapsed))
+
+    server.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
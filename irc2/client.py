@@ -1,8 +1,11 @@
 """irc2 client core"""
 
-from . import connection, event, ext, handler, utils
+from . import connection, event, ext, handler, parser, utils
 import asyncio
+import collections
 import logging
+import random
+import time
 
 class IRCClientConfig(object):
     """
@@ -10,38 +13,182 @@ class IRCClientConfig(object):
     object. Its basic usage is something like:
 
         conf = IRCClientConfig("chat.freenode.net", 6697)
+        conf.add_server("irc.example.net", 6697)
         conf.register("nick", "ident", "realname")
         conf.join("#channel", "#otherchannel")
         client = conf.configure()
         ... some event handler setup ...
         import asyncio
         asyncio.get_event_loop().run_forever()
+
+    The calls are replayed in order each time the connection is made, then
+    channels joined since the last connection are joined again and the
+    "ready" event is fired. When the connection is lost (including when the
+    server stops answering keepalive PINGs), the next server is tried after a
+    delay. The delay doubles with each failed attempt, up to max_backoff
+    seconds, and a random part of it is dropped so that many clients
+    disconnected together don't all come back at once.
+
+    Instance variables:
+        calls       the (path, args, kwargs) of each call to replay
+        reconnect   whether or not to reconnect when the connection is lost
+        backoff     the delay before reconnecting, in seconds
+        max_backoff the longest delay before reconnecting, in seconds
+        stable_after   seconds a registered connection must last before
+                       the delay is reset
+        connect_bucket a TokenBucket to take a token from before each
+                       connection attempt, or None
     """
 
-    def __init__(self, host, port, ssl=True):
+    def __init__(self, host, port, ssl=True, concurrency=None, reconnect=True, pool=None):
         self.conn = connection.IRCConnection(host, port, ssl)
-        self.client = IRCClient(self.conn)
-        self.coros = []
+        if pool is None:
+            self.client = IRCClient(self.conn, concurrency)
+            self.connect_bucket = None
+        else:
+            self.client = IRCClient(self.conn, dispatcher=pool.event, tasks=pool.tasks, budget=pool.budget)
+            self.connect_bucket = pool.connect_bucket
+        self.calls = []
+        self.channels = []
+
+        self.reconnect = reconnect
+        self.backoff = 5
+        self.max_backoff = 300
+        self.stable_after = 60
+
+    def add_server(self, host, port, ssl=True):
+        """
+        Add a server to fail over to. Servers are tried in the order they
+        were added.
+        """
+        self.conn.add_server(host, port, ssl)
 
     async def _run(self):
-        await self.conn.connect()
-        for coro in self.coros:
-            await coro
-        await self.client.handle()
+        await self.conn.prefetch()
+        failures = 0
+
+        while True:
+            started = time.monotonic()
+            rejoined = False
+            try:
+                if self.connect_bucket is not None:
+                    await self.connect_bucket.wait()
+                await self.conn.connect()
+                for path, args, kwargs in self.calls:
+                    await self._call(path, args, kwargs)
+
+                rejoin = [name for name in self.channels if self.client.state.channel(name) is None]
+                if rejoin:
+                    await self.client.join(*rejoin, wait=False)
+                rejoined = True
+                await self.client.event.fire("ready")
+                await self.conn.reader_task
+            except Exception as e:
+                logging.warning("Connection to %s lost: %r", self.conn.host, e)
+            finally:
+                await self._disconnect()
+
+            if rejoined:
+                self.channels = [channel.name for channel in self.client.state.channels.values()]
+            if self.client.registered and time.monotonic() - started > self.stable_after:
+                failures = 0
+            self.client.reset()
+
+            if not self.reconnect:
+                return
+
+            delay = min(self.max_backoff, self.backoff * 2 ** failures)
+            delay = random.uniform(delay / 2, delay)
+            failures += 1
+            logging.info("Reconnecting in %.1f seconds", delay)
+            await asyncio.sleep(delay)
+
+    async def _disconnect(self):
+        self.conn.close()
+        if self.conn.reader_task is not None:
+            await asyncio.wait([self.conn.reader_task])
 
     def configure(self):
         asyncio.get_event_loop().create_task(self._run())
         return self.client
 
-    def _add_coro(self, path, *args, **kwargs):
+    async def _call(self, path, args, kwargs):
         item = self.client
         for point in path:
             item = getattr(item, point)
-        self.coros.append(item(*args, **kwargs))
+        return await item(*args, **kwargs)
+
+    def _add_coro(self, path, *args, **kwargs):
+        self.calls.append((path, args, kwargs))
 
     def __getattr__(self, attr):
         return utils.AttrGetFollower([attr], self._add_coro)
 
+class IRCClientPool(object):
+    """
+    IRCClientPool runs many clients on one event loop, sharing a Dispatcher
+    and, optionally, a task pool for handlers and an overall send budget.
+    Connection attempts (including reconnects) are staggered, one every
+    "stagger" seconds, so that starting or reconnecting many clients doesn't
+    flood the server. Its usage is like that of IRCClientConfig:
+
+        pool = IRCClientPool(budget=utils.TokenBucket(20, 0.5))
+        for nick in nicks:
+            conf = pool.add("chat.freenode.net", 6697)
+            conf.register(nick, "ident", "realname")
+            conf.join("#channel")
+
+        @pool.event.message
+        async def on_message(client, message, prefix, target, text):
+            ...
+
+        pool.configure()
+        asyncio.get_event_loop().run_forever()
+
+    Handlers on pool.event receive the IRCClient the event came from before
+    the event's arguments.
+
+    Instance variables:
+        event       the Dispatcher shared by every client
+        tasks       the KeyedTaskPool handlers run in, or None to run them
+                    one at a time for each client
+        budget      the TokenBucket shared by every client's sends, or None
+        connect_bucket  the TokenBucket pacing connection attempts, or None
+        configs     the IRCClientConfig of each client
+    """
+
+    def __init__(self, budget=None, stagger=0.5, concurrency=None):
+        self.event = event.Dispatcher()
+        self.tasks = utils.KeyedTaskPool(concurrency) if concurrency else None
+        self.budget = budget
+        self.connect_bucket = utils.TokenBucket(1, stagger) if stagger else None
+        self.configs = []
+        self.started = set()
+
+    def add(self, host, port, ssl=True, reconnect=True):
+        """
+        Add a client connecting to the given server. Returns its
+        IRCClientConfig, to queue calls on and add fallback servers to.
+        """
+        conf = IRCClientConfig(host, port, ssl, reconnect=reconnect, pool=self)
+        self.configs.append(conf)
+        return conf
+
+    @property
+    def clients(self):
+        return [conf.client for conf in self.configs]
+
+    def configure(self):
+        """
+        Start every client which hasn't been started yet, and return the list
+        of clients.
+        """
+        for conf in self.configs:
+            if conf not in self.started:
+                self.started.add(conf)
+                conf.configure()
+        return self.clients
+
 class IRCClient(object):
     """
     IRCClient wraps an IRCConnection to provide helpers, manages extensions
@@ -52,95 +199,470 @@ class IRCClient(object):
     level events. Subscriptions to lower-level Messages are not required in
     most applications. Use decorators like "client.event.message" to subscribe
     functions to Dispatcher events.
+
+    By default, handlers run one message at a time, in order, in a task of
+    the client's own, so the connection's reader never waits for them and a
+    handler can wait for other messages (with IRCConnection.match, join,
+    request and so on). Once handler_backlog messages are waiting for their
+    handlers, reading pauses until they catch up (see
+    IRCConnection.pause_reading), unless a handler is waiting for a message.
+    If concurrency is given, handlers instead run as
+    tasks, with at most that many messages being handled at once. Messages
+    for the same channel (or from the same nick, for other messages) are
+    still handled in order. Messages waiting for their turn count towards
+    handler_backlog, so the reader itself never waits for a task. Either way, handlers subscribed with inline=True (which
+    keep track of state) run in the reader, before anyone waiting for the
+    message is woken.
+
+    Clients can share infrastructure (see IRCClientPool): given a dispatcher,
+    events are fired on it with the client as the first argument; given a
+    KeyedTaskPool as tasks, handlers run in it instead of a pool of the
+    client's own; and given a budget, every line sent also takes a token
+    from that TokenBucket.
     """
-    def __init__(self, irc):
+    send_priorities = {"PONG": 0, "CAP": 0, "AUTHENTICATE": 0,
+                       "PASS": 1, "NICK": 1, "USER": 1, "PING": 1, "QUIT": 1}
+    default_send_priority = 2
+    handler_backlog = 1024
+
+    def __init__(self, irc, concurrency=None, dispatcher=None, tasks=None, budget=None):
         self.subscriptions = []
-        self.bucket = utils.TokenBucket(4, 2)
-        self.event = event.Dispatcher()
+        if tasks is None and concurrency:
+            tasks = utils.KeyedTaskPool(concurrency)
+        self.tasks = tasks
+        self._verb_subscriptions = {}
+        self._wildcard_subscriptions = []
+        self._dispatch_cache = {}
+        self._batch_dispatch_cache = {}
+        self._batch_types = set()
+        self._handler_queue = collections.deque()
+        self._handler_task = None
+        self._handlers_pending = 0
+        self.bucket = utils.TokenBucket(4, 2, parent=budget)
+        self.event = dispatcher.bind(self) if dispatcher is not None else event.Dispatcher()
+
+        self.nick = None
+        self.ident = None
+        self.hostmask = None
+        self.registered = False
+        self.casemapping = "rfc1459"
 
         self.irc = irc
         self.irc.callback = self._run_handlers
+        self.scheduler = utils.SendScheduler(self.bucket, self.irc.send, fold=self.fold)
+        self.irc.scheduler = self.scheduler
 
         self.handler = handler.IRCHandler(self)
         self.cap = ext.IRCCaps(self)
         self.sasl = ext.IRCSasl(self)
         self.state = ext.IRCState(self)
+        self.batch = ext.IRCBatches(self)
+        self.labels = ext.IRCLabels(self)
+        self._request_locks = collections.defaultdict(asyncio.Lock)
+
+    def reset(self):
+        """
+        Forget what was learned from the server after the connection is
+        lost, including our nickname and hostmask (register sets them again).
+        Subscriptions, wanted capabilities and SASL credentials are kept,
+        and sends still waiting to go out fail with ConnectionError.
+        """
+        self.nick = None
+        self.ident = None
+        self.hostmask = None
+        self.registered = False
+        self.casemapping = "rfc1459"
+        self.features = utils.IDict()
+        self.cap.reset()
+        self.state.reset()
+        self.batch.reset()
+        self.labels.reset()
+        self.scheduler.clear(ConnectionError("Connection to {} closed".format(self.irc.host)))
 
-    async def send(self, *args):
+    async def send(self, *args, tags=None):
         """
-        Same as IRCConnection.send, but ratelimiting is enforced.
+        Same as IRCConnection.send, but ratelimiting and backpressure are
+        enforced. Lines wait in the send scheduler until a token is available:
+        replies to PING and capability/SASL negotiation go first, then
+        registration, then everything else. Messages to different targets
+        take turns. Completes once the line has been sent.
         """
-        await self.bucket.wait()
-        self.irc.send(*args)
+        if not args:
+            return
+
+        verb = args[0].split(" ", maxsplit=1)[0].upper()
+        priority = self.send_priorities.get(verb, self.default_send_priority)
+        dest = args[1] if len(args) > 2 else None
+        if tags:
+            args = (parser.format_line(*args, tags=tags),)
+
+        await self.scheduler.submit(priority, dest, args)
+        await self.irc.drain()
 
     async def register(self, nick, user, realname, password=None):
         """
         Send the server password (if set), nickname, user, and realname. Waits
         for registration to complete before finishing.
+
+        CAP LS 302 is sent along with the registration commands. Wanted
+        capabilities (see IRCCaps.want) are then requested together, with
+        AUTHENTICATE PLAIN right behind them if SASL credentials were given
+        (see IRCSasl.auth), and CAP END is sent once that is done.
+
+        If registration fails, including when SASL credentials were given
+        but the server can't do SASL, the connection is closed before the
+        exception is raised, rather than left waiting in capability
+        negotiation.
         """
-        await self.cap.end()
+        self.nick, self.ident = nick, user
+        welcome = self.irc.match(verb="001")
+        waiters = [welcome]
+
+        try:
+            ls_reply = await self.cap.ls()
+            waiters.append(ls_reply)
+            if password:
+                await self.send("PASS", password)
+            await self.send("NICK", nick)
+            await self.send("USER", user, user, user, realname)
+
+            await asyncio.wait([ls_reply, welcome], return_when=asyncio.FIRST_COMPLETED)
+            if not ls_reply.done():
+                # the server doesn't support capability negotiation
+                if self.sasl.credentials is not None:
+                    raise Exception("SASL not available")
+                return await welcome
+
+            available = ls_reply.result()
+            wanted = [cap for cap in self.cap.wanted if cap in available and cap not in self.cap.caps]
+            sasl = self.sasl.credentials is not None and "sasl" in wanted
+
+            acks = await self.cap.send_req(*wanted)
+            if sasl:
+                sasl_waiters = await self.sasl.start()
+                waiters.extend(sasl_waiters)
+            await acks
+
+            if sasl and "sasl" in self.cap.caps:
+                await self.sasl.finish(*sasl_waiters)
+            elif self.sasl.credentials is not None:
+                raise Exception("SASL not available")
 
-        if password:
-            await self.send("PASS", password)
-        await self.send("NICK", nick)
-        await self.send("USER", user, user, user, realname)
-        await self.irc.match(verb=["001"])
+            await self.cap.end()
+            await welcome
+        except Exception:
+            self.irc.close()
+            raise
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
 
-    def subscribe(self, pat, handler):
+    def subscribe(self, pat, handler, per_line=False, inline=False):
         """
         Subscribe the given handler to receive IRC messages that match the
-        given pattern. Message.matches rules apply.
+        given pattern. Message.matches rules apply, and handlers run in the
+        order they were subscribed in. The pattern is compiled when subscribing
+        (see Message.compile), so later changes to it have no effect.
+
+        Messages in an IRCv3 batch are passed on as a whole when the batch
+        ends (see IRCBatches), so by default handlers don't get them. If
+        per_line is True, the handler gets each of them too; it can also be a
+        collection of the batch types to get the messages of.
+
+        If inline is True, the handler runs in the connection's reader as
+        the message arrives, ahead of other handlers, so it must not wait for
+        other messages. This is for keeping track of state which code woken
+        by the message may look at.
         """
+        entry = (len(self.subscriptions), pat.compile(), handler, per_line, inline)
         self.subscriptions.append((pat, handler))
 
+        verbs = pat.verbs()
+        if verbs is None:
+            self._wildcard_subscriptions.append(entry)
+        else:
+            for verb in verbs:
+                self._verb_subscriptions.setdefault(verb, []).append(entry)
+        if per_line and per_line is not True:
+            self._batch_types.update(per_line)
+        self._dispatch_cache.clear()
+        self._batch_dispatch_cache.clear()
+
+    def _subscriptions_for(self, verb):
+        """
+        Get the (compiled pattern, handler, inline) tuples which could match a
+        message with the given verb, in subscription order. Results are cached
+        until the next call to subscribe, but only for verbs with subscriptions
+        of their own: every other verb shares the wildcard subscriptions' list,
+        so the cache can't grow with each new verb the server sends.
+        """
+        if verb not in self._verb_subscriptions:
+            verb = None
+        try:
+            return self._dispatch_cache[verb]
+        except KeyError:
+            entries = sorted(self._verb_subscriptions.get(verb, []) + self._wildcard_subscriptions,
+                             key=lambda entry: entry[0])
+            result = self._dispatch_cache[verb] = [(match, handler, inline)
+                                                   for _, match, handler, _, inline in entries]
+            return result
+
+    def _batch_subscriptions_for(self, verb, type):
+        """
+        Like _subscriptions_for, but only the tuples whose handler wants the
+        messages of batches of the given type. Batch types no handler asked
+        for by name share an entry, like verbs do.
+        """
+        if verb not in self._verb_subscriptions:
+            verb = None
+        if type not in self._batch_types:
+            type = None
+        try:
+            return self._batch_dispatch_cache[verb, type]
+        except KeyError:
+            entries = sorted(self._verb_subscriptions.get(verb, []) + self._wildcard_subscriptions,
+                             key=lambda entry: entry[0])
+            result = self._batch_dispatch_cache[verb, type] = [
+                (match, handler, inline) for _, match, handler, per_line, inline in entries
+                if per_line is True or (per_line and type in per_line)]
+            return result
+
+    def _dispatch_key(self, line):
+        """
+        Get the key used to order concurrent handling of a message: the
+        casefolded channel it was sent to, or else the casefolded source.
+        """
+        if line.args:
+            target = line.args[0]
+            chantypes = self.features.get("CHANTYPES")
+            if not isinstance(chantypes, str):
+                chantypes = "#&"
+            if target and target[0] in chantypes:
+                return self.fold(target)
+
+        if line.prefix is not None:
+            return self.fold(line.prefix.nick or line.prefix.prefix)
+        return None
+
     async def _run_handlers(self, line):
-        for pat, handler in self.subscriptions:
-            if pat.matches(line):
-                await handler(line)
+        batch = None
+        if self.batch.open and line.tags:
+            ref = line.tags.get("batch")
+            if ref is not None:
+                batch = self.batch.add(ref, line)
+        verb = line.verb
+        if len(verb) == 5 and verb == "BATCH":
+            self.batch.track(line)
+
+        if batch is None:
+            subscriptions = self._subscriptions_for(verb)
+        else:
+            subscriptions = self._batch_subscriptions_for(verb, batch.type)
+
+        handlers = []
+        for match, handler, inline in subscriptions:
+            if match(line):
+                if inline:
+                    await handler(line)
+                else:
+                    handlers.append(handler)
+        if not handlers:
+            return
+
+        if self.tasks is not None:
+            task = self.tasks.submit_nowait((self, self._dispatch_key(line)), self._call_handlers(handlers, line))
+            task.add_done_callback(self._handlers_done)
+            self._handlers_pending += 1
+            if self._handlers_pending >= self.handler_backlog:
+                self.irc.pause_reading()
+            return
+
+        self._handler_queue.append((handlers, line))
+        if len(self._handler_queue) >= self.handler_backlog:
+            self.irc.pause_reading()
+        if self._handler_task is None:
+            self._handler_task = asyncio.ensure_future(self._run_handler_queue())
+
+    def _handlers_done(self, task):
+        self._handlers_pending -= 1
+        if self.irc.reading_paused and self._handlers_pending < self.handler_backlog:
+            self.irc.resume_reading()
+
+    async def _run_handler_queue(self):
+        try:
+            while self._handler_queue:
+                handlers, line = self._handler_queue.popleft()
+                if self.irc.reading_paused and len(self._handler_queue) < self.handler_backlog:
+                    self.irc.resume_reading()
+                try:
+                    await self._call_handlers(handlers, line)
+                except Exception:
+                    logging.exception("Unhandled exception in handler")
+        finally:
+            self._handler_task = None
+
+    @staticmethod
+    async def _call_handlers(handlers, line):
+        for handler in handlers:
+            await handler(line)
 
     async def handle(self):
         """
-        Handle incoming IRC messages, dispatching them to subscribed handlers.
+        Handle incoming IRC messages until the connection is closed. Messages
+        are dispatched to subscribed handlers as the connection's reader task
+        receives them.
         """
         logging.info("Received event loop control, now dispatching events")
-        async for line in self.irc:
-            await self._run_handlers(line)
+        await self.irc.connect()
+        await self.irc.reader_task
+
+    ## Limits
+    def fold(self, s):
+        """
+        Casefold s with the server's CASEMAPPING (RFC1459 until the server
+        says otherwise). Unlike IStr comparisons, this doesn't depend on the
+        process-wide casing rules, so clients on networks with different
+        casemappings can run side by side.
+        """
+        return utils.fold(s, self.casemapping)
+
+    def line_length(self):
+        """
+        Get the maximum length of a line in bytes, including the CRLF. Uses
+        the server's LINELEN token, if any, or 512.
+        """
+        try:
+            return int(self.features.get("LINELEN", 512))
+        except ValueError:
+            return 512
+
+    def max_targets(self, command):
+        """
+        Get the maximum number of targets the server accepts for a command,
+        according to its TARGMAX token, or None if there is no limit.
+        Without TARGMAX (or with a malformed count), JOIN is unlimited and
+        everything else takes one.
+        """
+        default = None if command == "JOIN" else 1
+        targmax = self.features.get("TARGMAX")
+        if not isinstance(targmax, str):
+            return default
+
+        for item in targmax.split(","):
+            name, _, count = item.partition(":")
+            if name.upper() == command:
+                if not count:
+                    return None
+                try:
+                    return int(count)
+                except ValueError:
+                    return default
+        return default
+
+    def text_budget(self, command, target):
+        """
+        Get the number of bytes of text which fit in one "command target :text"
+        line, as relayed by the server with our hostmask as the prefix. If our
+        hostmask isn't known yet, the longest likely ident and host are
+        assumed.
+        """
+        mask = self.hostmask or "{}!{}@{}".format(self.nick or "", "x" * 10, "x" * 63)
+        overhead = len(":{} {} {} :\r\n".format(mask, command, target).encode("utf-8"))
+        return self.line_length() - overhead
 
     ## Commands
-    async def join(self, *channels):
+    async def request(self, *args, replies=None, end=None, timeout=None):
         """
-        Join the specified channel or channels.
+        Send a command, and return the list of messages the server sent in
+        reply to it.
+
+        If the labeled-response capability is enabled (see IRCLabels.enable),
+        replies are told apart by label, so any number of requests can wait
+        for replies at once, and the patterns are not used:
+
+        >>> await client.request("MODE", "#channel")  # doctest: +SKIP
+        [Message(tags={'label': '0'}, prefix=..., verb=324, args=[...])]
+
+        Otherwise, messages matching any of the replies patterns (a Message
+        or a list of them) are collected until one matching end (likewise) is
+        received, which is included; if end isn't given, the first reply
+        ends the request. Requests sending the same command then wait for
+        each other, so that their replies can't be mixed up.
+
+        If timeout is given, asyncio.TimeoutError is raised when the replies
+        don't arrive in time. Handlers can await this, unless they were
+        subscribed with inline=True.
         """
-        left = channels[:]
-        while left:
-            current, left = utils.join_max_length(left, ",", 400)
-            await self.send("JOIN", current)
+        if self.labels.available():
+            label, future = self.labels.new()
+            await self.send(*args, tags={"label": label})
+            return await asyncio.wait_for(future, timeout)
+
+        if replies is None and end is None:
+            raise Exception("Replies can't be matched without labeled-response or a pattern")
+        replies = [replies] if isinstance(replies, parser.Message) else list(replies or [])
+        end = [end] if isinstance(end, parser.Message) else list(end or replies)
+        return await asyncio.wait_for(self._request_unlabeled(args, replies, end), timeout)
+
+    async def _request_unlabeled(self, args, replies, end):
+        replies = [pat.compile() for pat in replies]
+        end = [pat.compile() for pat in end]
+
+        verb = args[0].split(" ", maxsplit=1)[0].upper()
+        async with self._request_locks[verb]:
+            queue = asyncio.Queue()
+            self.irc.listen(queue)
+            try:
+                await self.send(*args)
+                collected = []
+                while True:
+                    line = await queue.get()
+                    if line is None:
+                        raise ConnectionError("Connection closed before a reply arrived")
+                    if any(match(line) for match in end):
+                        collected.append(line)
+                        return collected
+                    if any(match(line) for match in replies):
+                        collected.append(line)
+            finally:
+                self.irc.queues.discard(queue)
+
+    async def who(self, mask):
+        """
+        Send WHO for the given mask, and return the RPL_WHOREPLY (or, with
+        WHOX, RPL_WHOSPCRPL) messages.
+        """
+        replies = await self.request("WHO", mask, replies=parser.Message(verb=["352", "354"]),
+                                     end=parser.Message(verb="315", args=[None, mask]))
+        return [reply for reply in replies if reply.verb in ("352", "354")]
+
+    async def join(self, *channels, wait=True):
+        """
+        Join the specified channel or channels. Channels are sent in as few
+        JOIN lines as the server's limits allow. Unless wait is false, this
+        waits until every channel has been joined.
+        """
+        joined = [self.irc.match(verb="JOIN", args=[channel]) for channel in channels] if wait else []
 
-        not_joined = set(channels)
-        while not_joined:
-            message = await self.irc.match(verb="JOIN")
-            channel = message.args[0]
-            not_joined.discard(channel)
+        budget = self.line_length() - len("JOIN \r\n")
+        for current in utils.join_limited(channels, ",", budget, self.max_targets("JOIN")):
+            await self.send("JOIN", current)
 
+        await asyncio.gather(*joined)
         return True
 
     async def say(self, dest, text):
         """
-        Send a message to the given destination with the given text.
+        Send a message to the given destination (or list of destinations) with
+        the given text. Long text is split at spaces where possible, to fit
+        the server's line length limit. Multiple destinations are combined
+        into one line where the server's TARGMAX allows.
         """
-        words = text.split(" ")
-        if all(len(word) < 350 for word in words):
-            # try to split at spaces when possible
-            left = words[:]
-            while left:
-                current, left = utils.join_max_length(left, " ", 350)
-                await self.send("PRIVMSG", dest, current)
+        dests = [dest] if isinstance(dest, str) else list(dest)
 
-        else:
-            left = text[:]
-            while left:
-                current, left = utils.join_max_length(left, "", 350)
-                await self.send("PRIVMSG", dest, current)
+        for targets in utils.join_limited(dests, ",", 200, self.max_targets("PRIVMSG")):
+            for chunk in utils.split_text(text, self.text_budget("PRIVMSG", targets)):
+                await self.send("PRIVMSG", targets, chunk)
 
 if __name__ == '__main__':
     import doctest
@@ -1,54 +1,384 @@
 """irc2 connection management"""
 
-from . import parser
+from . import parser, transport
 import asyncio
 import logging
+import socket
+import ssl
+import time
+
+dns_cache = {}
+dns_lookups = {}
+dns_ttl = 300
+
+async def resolve(host, port):
+    """
+    Resolve a host to a list of getaddrinfo results. Results are cached for
+    dns_ttl seconds and shared by every connection, concurrent lookups of the
+    same host share one query, and if a lookup fails the expired addresses
+    are used rather than giving up.
+    """
+    key = (host, port)
+    expires, infos = dns_cache.get(key, (0, None))
+    if infos is not None and expires > time.monotonic():
+        return infos
+
+    lookup = dns_lookups.get(key)
+    if lookup is None:
+        loop = asyncio.get_event_loop()
+        lookup = asyncio.ensure_future(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+        lookup.add_done_callback(lambda future: dns_lookups.pop(key, None))
+        dns_lookups[key] = lookup
+
+    try:
+        result = await asyncio.shield(lookup)
+    except OSError:
+        if infos is None:
+            raise
+        logging.warning("Resolving %s failed, using expired addresses", host)
+        return infos
+
+    dns_cache[key] = (time.monotonic() + dns_ttl, result)
+    return result
+
+class ResumingContext(ssl.SSLContext):
+    """
+    An SSLContext which offers the TLS session in its session attribute, if
+    any, when wrapping a new connection, so reconnecting can skip the full
+    handshake.
+    """
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname,
+                                session or self.session)
 
 class IRCConnection(object):
     """
     IRCConnection respresents the lowest level of abstraction in the library.
-    It exposes an iterator interface over incoming messages, as well as helpers
-    to wait for messages matching a certain pattern.
+    Once connected, a single reader task parses each incoming line and hands
+    it to the callback, to anyone waiting for a matching message, and to any
+    iterators over incoming messages.
 
-    >>> for message in conn:  # doctest: +SKIP
+    >>> async for message in conn:  # doctest: +SKIP
     ...     print(message)
     ...     break
     Message(tags={}, prefix="orwell.freenode.net", verb="NOTICE", args=["*", "Looking up your hostname..."])
 
+    Each call to connect uses the next server added with add_server, trying
+    each of its addresses in turn. While connected, the server is sent a PING
+    every ping_interval seconds; lag is the time the last reply took, and the
+    connection is closed if no reply arrives within ping_timeout seconds.
+
     Instance variables:
         host        the IRC server to connect to
         port        the IRC server's port
-        ssl         whether or not to attempt a secure connection
+        ssl         whether or not to attempt a secure connection (or an
+                    SSLContext to use)
+        servers     a list of (host, port, ssl) tuples to connect to in turn
         connected   whether or not a connection has been established
-        callback    a function to call when a message is received while waiting
-                    for a pattern to be matched
+        callback    a coroutine function to await with every message
+                    received; the reader waits for it, so it mustn't wait
+                    for later messages
+        reader_task the task reading from the server, or None
+        lag         the round trip time of the last PING, in seconds, or None
+        ping_interval  seconds between keepalive PINGs, or None to disable
+        ping_timeout   seconds to wait for a PONG before giving up
+        scheduler   a utils.SendScheduler to send keepalive PINGs through,
+                    ahead of everything else, or None to send them directly
+        reading_paused  whether reading has been paused (see pause_reading)
+        line_protocol  whether to read through a transport.LineProtocol,
+                       which hands over every line received at once,
+                       rather than a StreamReader
     """
 
-    def __init__(self, host="chat.freenode.net", port=6697, ssl=True):
+    def __init__(self, host="chat.freenode.net", port=6697, ssl=True, line_protocol=False):
         self.host = host
         self.port = port
         self.ssl = ssl
+        self.line_protocol = line_protocol
+        self.servers = [(host, port, ssl)]
+        self.server_index = 0
         self.connected = False
         self.callback = None
+        self.reader_task = None
+        self.reading_paused = False
+        self.resume_waiter = None
+
+        self.lag = None
+        self.ping_interval = 60
+        self.ping_timeout = 60
+        self.scheduler = None
+        self.keepalive_task = None
+        self.tls_context = None
+        self.tls_object = None
+        self.tls_sessions = {}
+
+        self.waiters = {}
+        self.wildcard_waiters = []
+        self.queues = set()
+        self.expected = set()
+
+        self.outgoing = []
+        self.flush_scheduled = False
+        self.flushed = None
 
     async def connect(self):
         """
-        Idempotently establish a connection to the IRC server.
+        Idempotently establish a connection to the IRC server, and start
+        reading from it.
         """
         if not self.connected:
-            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+            self.host, self.port, self.ssl = self.servers[self.server_index]
+            self.server_index = (self.server_index + 1) % len(self.servers)
+
+            context = self._tls_context()
+            error = None
+            for family, _, _, _, address in await resolve(self.host, self.port):
+                try:
+                    self.reader, self.writer = await self._open(address[0], family, context)
+                    break
+                except OSError as e:
+                    logging.warning("Connecting to %s (%s) failed: %s", self.host, address[0], e)
+                    error = e
+            else:
+                raise error or ConnectionError("No addresses for {}".format(self.host))
+
             self.connected = True
+            self.reading_paused = False
+            self.lag = None
+            self.tls_object = self.writer.get_extra_info("ssl_object")
+            if self.tls_object is not None and self.tls_object.session_reused:
+                logging.info("Resumed TLS session with %s", self.host)
+            self.reader_task = asyncio.ensure_future(self._read_loop())
+            if self.ping_interval:
+                self.keepalive_task = asyncio.ensure_future(self._keepalive())
 
         return self
 
-    async def __aiter__(self):
+    def add_server(self, host, port=6697, ssl=True):
+        """
+        Add a server to connect to if the others are unavailable.
+        """
+        self.servers.append((host, port, ssl))
+
+    async def prefetch(self):
+        """
+        Resolve every server's address ahead of time, so that failing over
+        to another server does not wait on DNS.
+        """
+        lookups = [resolve(host, port) for host, port, _ in self.servers]
+        await asyncio.gather(*lookups, return_exceptions=True)
+
+    def _tls_context(self):
+        if self.ssl is not True:
+            return self.ssl or None
+
+        if self.tls_context is None:
+            self.tls_context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+            self.tls_context.load_default_certs()
+        self.tls_context.session = self.tls_sessions.get((self.host, self.port))
+        return self.tls_context
+
+    def _save_tls_session(self):
+        if self.tls_object is None:
+            return
+        try:
+            if self.tls_object.session is not None:
+                self.tls_sessions[(self.host, self.port)] = self.tls_object.session
+        except (ValueError, ssl.SSLError):
+            pass
+
+    async def _open(self, address, family, context):
+        server_hostname = self.host if context else None
+        if not self.line_protocol:
+            return await asyncio.open_connection(address, self.port, family=family, ssl=context,
+                                                 server_hostname=server_hostname)
+
+        loop = asyncio.get_event_loop()
+        _, protocol = await loop.create_connection(transport.LineProtocol, address, self.port, family=family,
+                                                   ssl=context, server_hostname=server_hostname)
+        return protocol, protocol
+
+    async def _read_loop(self):
+        try:
+            if self.line_protocol:
+                await self._read_batches()
+                return
+
+            while True:
+                raw = await self.reader.readline()
+                if not raw:
+                    break
+
+                line = parser.parse_line(raw)
+                if line is not None:
+                    await self.dispatch(line)
+                    if self.reading_paused:
+                        await self._wait_for_resume()
+        finally:
+            self.connected = False
+            if self.keepalive_task is not None:
+                self.keepalive_task.cancel()
+                self.keepalive_task = None
+            self._save_tls_session()
+            self.writer.close()
+            self.outgoing = []
+            self._close_waiters()
+
+    async def _read_batches(self):
+        while True:
+            lines = await self.reader.read_lines()
+            if not lines:
+                return
+
+            for line in map(parser.parse_line, lines):
+                if line is not None:
+                    await self.dispatch(line)
+                    if self.reading_paused:
+                        await self._wait_for_resume()
+
+    async def _keepalive(self):
+        while self.connected:
+            await asyncio.sleep(self.ping_interval)
+            token = "irc2-{:.0f}".format(time.monotonic() * 1000)
+            pong = self.match(verb="PONG", args=[None, token])
+            if self.scheduler is not None:
+                try:
+                    await self.scheduler.submit(0, None, ("PING", token))
+                except ConnectionError:
+                    pong.cancel()
+                    return
+            else:
+                self.send("PING", token)
+            sent = time.monotonic()
+            try:
+                await asyncio.wait_for(pong, self.ping_timeout)
+            except asyncio.TimeoutError:
+                logging.warning("No PONG from %s in %s seconds, disconnecting", self.host, self.ping_timeout)
+                self.close()
+                return
+            self.lag = time.monotonic() - sent
+
+    def close(self):
+        """
+        Close the connection. The reader task finishes once the connection
+        is closed, and anything waiting on a message gets a ConnectionError.
+        """
+        if self.connected:
+            self.writer.transport.abort()
+            self.resume_reading()
+
+    def pause_reading(self):
+        """
+        Stop handing out messages after the current one until resume_reading
+        is called, leaving the rest to back up on the socket. Messages are
+        still read while anything is waiting for one (see match and expect)
+        or iterating over them, since that message may be what lets reading
+        resume, such as the reply a handler waits for before it can finish.
+        """
+        self.reading_paused = True
+
+    def resume_reading(self):
+        """
+        Carry on reading after pause_reading.
+        """
+        self.reading_paused = False
+        self._wake_reader()
+
+    def expect(self, future):
+        """
+        Keep reading while future is pending, even if reading is paused, for
+        code waiting on a message by other means than match.
+        """
+        self.expected.add(future)
+        future.add_done_callback(self.expected.discard)
+        self._wake_reader()
+
+    def _wake_reader(self):
+        waiter = self.resume_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def _wait_for_resume(self):
+        while self.reading_paused and not (self.waiters or self.wildcard_waiters or
+                                           self.queues or self.expected):
+            self.resume_waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self.resume_waiter
+            finally:
+                self.resume_waiter = None
+
+    async def dispatch(self, line):
+        """
+        Hand a parsed message to the callback, to waiters whose patterns match
+        it, and to iterators. This is called by the reader task for each line.
+        """
+        if self.callback is not None:
+            await self.callback(line)
+
+        waiters = self.waiters.get(line.verb)
+        if waiters:
+            remaining = self._resolve(waiters, line)
+            if remaining:
+                self.waiters[line.verb] = remaining
+            else:
+                del self.waiters[line.verb]
+        if self.wildcard_waiters:
+            self.wildcard_waiters = self._resolve(self.wildcard_waiters, line)
+
+        for queue in self.queues:
+            queue.put_nowait(line)
+
+    @staticmethod
+    def _resolve(waiters, line):
+        remaining = []
+        for match, future in waiters:
+            if future.done():
+                continue
+            elif match(line):
+                future.set_result(line)
+            else:
+                remaining.append((match, future))
+        return remaining
+
+    def _close_waiters(self):
+        error = ConnectionError("Connection to {} closed".format(self.host))
+        for waiters in list(self.waiters.values()) + [self.wildcard_waiters]:
+            for match, future in waiters:
+                if not future.done():
+                    future.set_exception(error)
+        self.waiters = {}
+        self.wildcard_waiters = []
+
+        for queue in self.queues:
+            queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
         await self.connect()
-        return self
+        queue = asyncio.Queue()
+        self.listen(queue)
+        try:
+            while True:
+                line = await queue.get()
+                if line is None:
+                    return
+                yield line
+        finally:
+            self.queues.discard(queue)
 
-    async def __anext__(self):
-        return parser.parse_line(await self.reader.readline())
+    def listen(self, queue):
+        """
+        Put every message read from now on in queue (and None once the
+        connection is closed), until queue is removed from queues.
+        """
+        self.queues.add(queue)
+        self._wake_reader()
 
-    async def match(self, *pats, **kwargs):
+    def match(self, *pats, timeout=None, **kwargs):
         """
         Wait for a message matching a pattern. Follows the Message.matches
         rules for matching. Multiple Messages can be passed, or keyword
@@ -56,34 +386,101 @@ class IRCConnection(object):
 
         >>> await conn.match(verb="PRIVMSG")  # doctest: +SKIP
         >>> await conn.match(Message(verb="PRIVMSG"), Message(args=["#channel"]))  # doctest: +SKIP
+
+        The waiter is registered as soon as match is called, so it is safe to
+        call match before sending the command the reply belongs to and await
+        the result afterwards. If timeout is given, asyncio.TimeoutError is
+        raised when no message matches in time.
+
+        Waiters are woken by the reader task, right after the callback, so
+        the callback itself must not wait for a match (IRCClient runs its
+        handlers apart from the reader, so they can).
         """
         if len(pats):
             pats = pats
         else:
             pats = [parser.Message(**kwargs)]
 
-        while True:
-            line = parser.parse_line(await self.reader.readline())
-            await self.callback(line)
-            if any(pat.matches(line) for pat in pats):
-                return line
+        future = asyncio.get_event_loop().create_future()
+        keys = set()
+        for pat in pats:
+            entry = (pat.compile(), future)
+            verbs = pat.verbs()
+            if verbs is None:
+                self.wildcard_waiters.append(entry)
+                keys.add(None)
+            else:
+                for verb in verbs:
+                    self.waiters.setdefault(verb, []).append(entry)
+                    keys.add(verb)
+        future.add_done_callback(lambda future: self._forget(future, keys))
+        self._wake_reader()
 
-    def send(self, *args):
+        if timeout is not None:
+            return asyncio.wait_for(future, timeout)
+        return future
+
+    def _forget(self, future, keys):
+        """
+        Remove a finished waiter from the waiter lists it was added to (the
+        given verbs, with None for the wildcard list), whether it matched
+        through another of them, timed out or was cancelled.
         """
-        Send an IRC message immediately.
+        for key in keys:
+            if key is None:
+                self.wildcard_waiters = [entry for entry in self.wildcard_waiters if entry[1] is not future]
+                continue
+
+            waiters = self.waiters.get(key)
+            if waiters is None:
+                continue
+            waiters = [entry for entry in waiters if entry[1] is not future]
+            if waiters:
+                self.waiters[key] = waiters
+            else:
+                del self.waiters[key]
+
+    def send(self, *args, tags=None):
+        """
+        Queue an IRC message to be sent, optionally with a dict of message
+        tags. Lines queued during the same event loop iteration are written to
+        the socket together.
 
         >>> conn.send("PRIVMSG", "#channel", "hello there")  # doctest: +SKIP
         """
         if len(args) == 0:
             return
-        elif len(args) == 1:
-            line = args[0].encode()
-        else:
-            line = (" ".join(args[:-1]) + " :" + args[-1]).encode()
 
-        if not line.endswith(b"\n"):
-            line = line + b"\n"
+        line = parser.format_line(*args, tags=tags)
+        logging.info("Send: %r", line)
+        self.outgoing.append(line)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self.flush)
 
-        logging.info("Send: {}".format(parser.parse_line(line)))
-        self.writer.write(line)
+    def flush(self):
+        """
+        Write all queued lines to the socket now.
+        """
+        self.flush_scheduled = False
+        if self.outgoing:
+            data, self.outgoing = b"".join(self.outgoing), []
+            if self.connected:
+                self.writer.write(data)
+
+        flushed, self.flushed = self.flushed, None
+        if flushed is not None and not flushed.done():
+            flushed.set_result(None)
 
+    async def drain(self):
+        """
+        Wait until queued lines have been written to the socket, then until
+        the socket's write buffer is below its high-water mark. Lines queued
+        during the current event loop iteration are still written together,
+        and this limits how far ahead of the network senders can get.
+        """
+        if self.flush_scheduled:
+            if self.flushed is None:
+                self.flushed = asyncio.get_event_loop().create_future()
+            await asyncio.shield(self.flushed)
+        await self.writer.drain()
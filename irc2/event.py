@@ -5,11 +5,16 @@ class Dispatcher(object):
     Dispatcher maintains a list of functions and classes which should receive
     events (which are essentially just a (name, args) pair) and provides
     facilities to call all the functions associated with an event.
+
+    A table from each event to the callables which should receive it is kept
+    up to date as handlers are added and removed, so firing an event is a
+    single lookup.
     """
 
     def __init__(self):
         self.handler_classes = []
         self.handlers = collections.defaultdict(list)
+        self.table = {}
 
     def subscribe(self, event, handler):
         """
@@ -29,11 +34,30 @@ class Dispatcher(object):
         handler2 5
         """
         self.handlers[event].append(handler)
+        self._rebuild(event)
+
+    def unsubscribe(self, event, handler):
+        """
+        Remove a handler function previously added with subscribe.
+
+        >>> d = Dispatcher()
+        >>> async def handler(n):
+        ...     print("handler {}".format(n))
+        >>> d.subscribe("number", handler)
+        >>> d.unsubscribe("number", handler)
+        >>> "number" in d.table
+        False
+        """
+        self.handlers[event].remove(handler)
+        if not self.handlers[event]:
+            del self.handlers[event]
+        self._rebuild(event)
 
     def add_handler(self, obj):
         """
         Add a handler object. Handler objects should have methods with names
-        like "on_event" (which will be called when "event" is fired).
+        like "on_event" (which will be called when "event" is fired). The
+        object's methods are looked up once, when it is added.
 
         >>> class MyHandler:
         ...     @staticmethod
@@ -46,15 +70,42 @@ class Dispatcher(object):
         myhandler 5
         """
         self.handler_classes.append(obj)
+        for event in self._handler_events(obj):
+            self._rebuild(event)
 
-    async def fire(self, event, *args):
-        for handler in self.handlers[event]:
-            await handler(*args)
+    def remove_handler(self, obj):
+        """
+        Remove a handler object previously added with add_handler.
+        """
+        self.handler_classes.remove(obj)
+        for event in self._handler_events(obj):
+            self._rebuild(event)
 
+    @staticmethod
+    def _handler_events(obj):
+        return {name[3:] for name in dir(obj)
+                if name.startswith("on_") and callable(getattr(obj, name, None))}
+
+    def _rebuild(self, event):
+        name = "on_" + event
+        handlers = list(self.handlers.get(event, ()))
         for handler_class in self.handler_classes:
-            f = getattr(handler_class, "on_{}".format(event), None)
+            f = getattr(handler_class, name, None)
             if f is not None:
-                await f(*args)
+                handlers.append(f)
+
+        if handlers:
+            self.table[event] = tuple(handlers)
+        else:
+            self.table.pop(event, None)
+
+    async def fire(self, event, *args):
+        handlers = self.table.get(event)
+        if handlers is None:
+            return
+
+        for handler in handlers:
+            await handler(*args)
 
     def __getattr__(self, attr):
         def decorator(f):
@@ -62,6 +113,45 @@ class Dispatcher(object):
             return f
         return decorator
 
+    def bind(self, source):
+        """
+        Get a BoundDispatcher which fires this dispatcher's events with source
+        as the first argument.
+        """
+        return BoundDispatcher(self, source)
+
+class BoundDispatcher(object):
+    """
+    BoundDispatcher fires the events of a shared Dispatcher with the source of
+    the event (such as the IRCClient it came from) passed to handlers before
+    the event's own arguments. Everything else, like subscribing, is done on
+    the shared Dispatcher, so many sources can share one set of handlers.
+
+    >>> d = Dispatcher()
+    >>> @d.number
+    ... async def handler(source, n):
+    ...     print("{} {}".format(source, n))
+    >>> import asyncio
+    >>> asyncio.get_event_loop().run_until_complete(d.bind("a").fire("number", 5))
+    a 5
+    """
+    __slots__ = ("dispatcher", "source")
+
+    def __init__(self, dispatcher, source):
+        self.dispatcher = dispatcher
+        self.source = source
+
+    async def fire(self, event, *args):
+        handlers = self.dispatcher.table.get(event)
+        if handlers is None:
+            return
+
+        for handler in handlers:
+            await handler(self.source, *args)
+
+    def __getattr__(self, attr):
+        return getattr(self.dispatcher, attr)
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
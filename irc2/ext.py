@@ -4,40 +4,148 @@ from . import parser, utils
 import asyncio
 import base64
 import collections
+import sys
+
+def parse_caps(caps):
+    """
+    Parse a list of capabilities from CAP LS or CAP NEW into a dict of names
+    to values. Capabilities without a value are mapped to True.
+
+    >>> parse_caps("multi-prefix sasl=PLAIN,EXTERNAL") == {"multi-prefix": True, "sasl": "PLAIN,EXTERNAL"}
+    True
+    """
+    result = {}
+    for cap in caps.split():
+        name, _, value = cap.partition("=")
+        result[name] = value or True
+    return result
 
 class IRCCaps(object):
     """
-    IRCCaps manages IRCv3 capabilities.
+    IRCCaps manages IRCv3 capabilities. Capabilities passed to want() before
+    registration are requested by IRCClient.register, in as few CAP REQ lines
+    as possible, once CAP LS 302 shows the server offers them.
+
+    Instance variables:
+        caps        The set of enabled capabilities.
+        available   A dict of the capabilities the server offers to their
+                    values (True for capabilities without a value).
+        wanted      The set of capabilities to request if they are offered,
+                    including when the server announces them with CAP NEW.
     """
     def __init__(self, client):
         self.client = client
         self.caps = set()
+        self.available = {}
+        self.wanted = set()
         self.waiting_caps = utils.IDefaultDict(asyncio.Future)
+        self.ls_reply = None
+        self._ls_caps = []
 
-        client.subscribe(parser.Message(verb="CAP"), self._handle_cap)
+        client.subscribe(parser.Message(verb="CAP"), self._handle_cap, per_line=True, inline=True)
+
+    def reset(self):
+        """
+        Forget the enabled and offered capabilities, keeping the wanted ones
+        so that they are requested again on the next connection.
+        """
+        self.caps = set()
+        self.available = {}
+        self.waiting_caps = utils.IDefaultDict(asyncio.Future)
+        self.ls_reply = None
+        self._ls_caps = []
 
     async def _handle_cap(self, message):
-        _, sub = message.args[:2]
-        if sub == "ACK" or sub == "NAK":
-            caps = message.args[2]
-            for cap in caps.split():
-                if sub == "ACK":
-                    self.caps.add(cap)
-                    self.waiting_caps[cap].set_result(True)
-                elif sub == "NAK":
-                    self.waiting_caps[cap].set_result(False)
+        if len(message.args) < 3:
+            return
+
+        sub = message.args[1].upper()
+        if sub == "LS":
+            self._ls_caps.append(message.args[-1])
+            if len(message.args) > 3 and message.args[2] == "*":
+                return
+            self.available = parse_caps(" ".join(self._ls_caps))
+            self._ls_caps = []
+            if self.ls_reply is not None and not self.ls_reply.done():
+                self.ls_reply.set_result(self.available)
+
+        elif sub == "ACK" or sub == "NAK":
+            for cap in message.args[-1].split():
+                name = cap.lstrip("-~=")
+                if sub == "ACK" and cap.startswith("-"):
+                    self.caps.discard(name)
+                elif sub == "ACK":
+                    self.caps.add(name)
+
+                future = self.waiting_caps[name]
+                if not future.done():
+                    future.set_result(sub == "ACK")
+
+        elif sub == "NEW":
+            new = parse_caps(message.args[-1])
+            self.available.update(new)
+            wanted = [cap for cap in new if cap in self.wanted and cap not in self.caps]
+            if wanted:
+                asyncio.ensure_future(self.req(*wanted))
+
+        elif sub == "DEL":
+            for cap in message.args[-1].split():
+                self.available.pop(cap, None)
+                self.caps.discard(cap)
+                self.waiting_caps.pop(cap, None)
+
+    async def ls(self):
+        """
+        Send CAP LS 302, which holds registration until end() is called.
+        Returns a future which resolves to the available capabilities once
+        the (possibly multi-line) reply has arrived.
+        """
+        self.ls_reply = asyncio.get_event_loop().create_future()
+        reply = self.ls_reply
+        await self.client.send("CAP", "LS", "302")
+        return reply
+
+    async def want(self, *caps):
+        """
+        Request the given capabilities whenever they are offered. Before
+        registration, they are requested by IRCClient.register and this
+        returns True straight away. Afterwards, the ones the server offers
+        are requested immediately and this returns True if they are all
+        enabled.
+        """
+        self.wanted.update(caps)
+        if not self.client.registered:
+            return True
+
+        offered = [cap for cap in caps if cap in self.available]
+        if len(offered) < len(caps):
+            await self.req(*offered)
+            return False
+        return await self.req(*offered)
+
+    async def req(self, *caps):
+        """
+        Request capabilities from the server, using as few CAP REQ lines as
+        possible. Returns True if we already have all of the capabilities or
+        the server ACKed them, or False if the server responded with NAK to
+        any of them. Note that the server rejects a whole CAP REQ line if it
+        doesn't know one of its capabilities.
+        """
+        return all(await (await self.send_req(*caps)))
 
-    async def req(self, cap):
+    async def send_req(self, *caps):
         """
-        Request a capability from the server. Returns True if we already have
-        the capability, or if the server ACKed our request, or False if the
-        server responded with NAK.
+        Send CAP REQ lines for the given capabilities, like req, but without
+        waiting for the reply. Returns a future which resolves to a list of
+        booleans, one per capability.
         """
-        await self.client.send("CAP", "REQ", cap)
-        while not self.waiting_caps[cap].done():
-            await self.client.irc.match(verb="CAP")
+        pending = [cap for cap in caps if not self.waiting_caps[cap].done()]
+
+        budget = self.client.line_length() - len("CAP REQ :\r\n")
+        for line in utils.join_limited(pending, " ", budget):
+            await self.client.send("CAP", "REQ", line)
 
-        return self.waiting_caps[cap].result()
+        return asyncio.gather(*(self.waiting_caps[cap] for cap in caps))
 
     async def end(self):
         await self.client.send("CAP", "END")
@@ -45,40 +153,540 @@ class IRCCaps(object):
 class IRCSasl(object):
     """
     IRCSasl manages SASL authentication.
+
+    Instance variables:
+        credentials A (user, password) tuple to authenticate with during
+                    registration, or None.
     """
+    result_numerics = ["902", "903", "904", "905", "906", "907"]
+
     def __init__(self, client):
         self.client = client
+        self.credentials = None
 
     async def auth(self, user, password):
         """
         Perform SASL PLAIN authentication with the given username and password.
+        If called before registration, the credentials are stored and used
+        by IRCClient.register, which raises an exception if authentication
+        fails.
         """
+        self.credentials = (user, password)
+        if not self.client.registered:
+            self.client.cap.wanted.add("sasl")
+            return True
+
         if not await self.client.cap.req("sasl"):
             raise Exception("SASL not available")
+        return await self.finish(*await self.start())
 
+    async def start(self):
+        """
+        Send AUTHENTICATE PLAIN. Returns waiters for the server's reply, to be
+        passed to finish().
+        """
+        waiters = (self.client.irc.match(verb="AUTHENTICATE", args=["+"]),
+                   self.client.irc.match(verb=self.result_numerics))
         await self.client.send("AUTHENTICATE", "PLAIN")
-        await self.client.irc.match(verb="AUTHENTICATE", args=["+"])
+        return waiters
 
-        data = base64.b64encode("{0}\x00{0}\x00{1}".format(user, password).encode()).decode()
-        await self.client.send("AUTHENTICATE", data)
-        result = await self.client.irc.match(verb=["902", "903", "904"])
-        if result.verb != "903":
+    async def finish(self, ready, result):
+        """
+        Send the stored credentials once the server is ready for them, and
+        wait for the result.
+        """
+        await asyncio.wait([ready, result], return_when=asyncio.FIRST_COMPLETED)
+        if ready.done():
+            user, password = self.credentials
+            data = base64.b64encode("{0}\x00{0}\x00{1}".format(user, password).encode()).decode()
+            for idx in range(0, len(data), 400):
+                await self.client.send("AUTHENTICATE", data[idx:idx + 400])
+            if len(data) % 400 == 0:
+                await self.client.send("AUTHENTICATE", "+")
+        else:
+            ready.cancel()
+
+        if (await result).verb != "903":
             raise Exception("SASL authentication failed")
         return True
 
+class Batch(object):
+    """
+    Batch holds the messages of an IRCv3 batch.
+
+    Instance variables:
+        ref         The batch's reference tag.
+        type        The batch type, like "netsplit" or "chathistory".
+        params      The batch's parameters.
+        messages    The messages in the batch, in the order they arrived.
+    """
+    __slots__ = ("ref", "type", "params", "messages")
+
+    def __init__(self, ref, type, params):
+        self.ref = ref
+        self.type = type
+        self.params = params
+        self.messages = []
+
+class IRCBatches(object):
+    """
+    IRCBatches collects the messages of IRCv3 batches (see enable), and
+    passes each batch to handlers as a whole when it ends, instead of one
+    message at a time. The "batch" event is fired with the batch's type,
+    messages and parameters; netsplit and netjoin batches also fire the
+    "netsplit" or "netjoin" event with the servers (the batch's parameters)
+    and the nicknames of the users who quit or joined.
+
+    Messages in a batch are only passed to subscribed handlers which ask
+    for them with IRCClient.subscribe's per_line argument. Nested batches
+    are passed on separately, each when it ends.
+
+    Instance variables:
+        open        A dict of reference tags to Batches which haven't ended.
+        closed      A dict of reference tags to Batches which have ended but
+                    haven't been passed on yet.
+        live_types  The types of batch whose messages are about what is
+                    happening now (as opposed to history), which state
+                    tracking has to see line by line.
+    """
+    live_types = frozenset(["netsplit", "netjoin", "labeled-response"])
+
+    def __init__(self, client):
+        self.client = client
+        self.open = {}
+        self.closed = {}
+
+        client.subscribe(parser.Message(verb="BATCH"), self._handle_batch, per_line=True)
+
+    async def enable(self):
+        """
+        Request the batch capability (see IRCCaps.want).
+        """
+        return await self.client.cap.want("batch")
+
+    def reset(self):
+        """
+        Forget batches which haven't been passed on.
+        """
+        self.open = {}
+        self.closed = {}
+
+    def get(self, ref):
+        """
+        Get the Batch with the given reference tag, if it hasn't been passed
+        on yet.
+        """
+        return self.open.get(ref) or self.closed.get(ref)
+
+    def add(self, ref, message):
+        """
+        Add a message to the open batch with the given reference tag, and
+        return the Batch, or None if there is no such batch.
+        """
+        batch = self.open.get(ref)
+        if batch is not None:
+            batch.messages.append(message)
+        return batch
+
+    def track(self, message):
+        """
+        Start or end a batch for a BATCH message. This is called by the
+        client as each message arrives, so that batches hold their messages
+        in order even when handlers run concurrently.
+        """
+        if not message.args or len(message.args[0]) < 2:
+            return
+
+        ref = message.args[0]
+        if ref[0] == "+" and len(message.args) >= 2:
+            self.open[ref[1:]] = Batch(ref[1:], message.args[1], message.args[2:])
+        elif ref[0] == "-":
+            batch = self.open.pop(ref[1:], None)
+            if batch is not None:
+                self.closed[ref[1:]] = batch
+
+    async def _handle_batch(self, message):
+        if message.args and message.args[0][:1] == "-":
+            batch = self.closed.pop(message.args[0][1:], None)
+            if batch is not None:
+                await self._finish(batch)
+
+    async def _finish(self, batch):
+        event = self.client.event
+        if batch.type in ("netsplit", "netjoin"):
+            verb = "QUIT" if batch.type == "netsplit" else "JOIN"
+            users = [message.prefix.nick for message in batch.messages
+                     if message.verb == verb and message.prefix is not None]
+            await event.fire(batch.type, tuple(batch.params), users)
+        await event.fire("batch", batch.type, batch.messages, batch.params)
+
+class IRCLabels(object):
+    """
+    IRCLabels matches replies to commands sent with IRCClient.request using
+    the labeled-response capability (see enable). Each command gets a unique
+    label tag, and the reply the server labels with it resolves the command's
+    future: with the labeled message, with the messages of a labeled batch
+    (when it ends), or with nothing for an ACK.
+
+    Instance variables:
+        pending     A dict of labels to futures for their replies.
+        batches     A dict of reference tags to the labeled-response Batches
+                    which haven't ended, and their futures.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.pending = {}
+        self.batches = {}
+        self.next_label = 0
+
+        client.subscribe(parser.Message(tags={"label": None}), self._handle_labeled,
+                         per_line=True, inline=True)
+        client.subscribe(parser.Message(verb="BATCH"), self._handle_batch, per_line=True, inline=True)
+
+    async def enable(self):
+        """
+        Request the labeled-response and batch capabilities (see
+        IRCCaps.want).
+        """
+        await self.client.cap.want("batch")
+        return await self.client.cap.want("labeled-response")
+
+    def available(self):
+        """
+        Get whether or not replies can be matched by label.
+        """
+        return "labeled-response" in self.client.cap.caps
+
+    def reset(self):
+        """
+        Fail the commands still waiting for replies with ConnectionError.
+        """
+        error = ConnectionError("Connection closed before a reply arrived")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending = {}
+        self.batches = {}
+
+    def new(self):
+        """
+        Get a new label, and the future for its reply.
+        """
+        label = "{:x}".format(self.next_label)
+        self.next_label += 1
+
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(lambda future: self.pending.pop(label, None))
+        self.pending[label] = future
+        self.client.irc.expect(future)
+        return label, future
+
+    async def _handle_labeled(self, message):
+        future = self.pending.get(message.tags["label"])
+        if future is None or future.done():
+            return
+
+        if message.verb == "BATCH" and message.args and message.args[0][:1] == "+":
+            batch = self.client.batch.get(message.args[0][1:])
+            if batch is not None:
+                self.batches[batch.ref] = (batch, future)
+                return
+        future.set_result([] if message.verb == "ACK" else [message])
+
+    async def _handle_batch(self, message):
+        if not self.batches or not message.args or message.args[0][:1] != "-":
+            return
+
+        batch, future = self.batches.pop(message.args[0][1:], (None, None))
+        if future is not None and not future.done():
+            future.set_result(batch.messages)
+
+class User(object):
+    """
+    User is a user we share at least one channel with (or ourselves).
+
+    Instance variables:
+        nick        The user's nickname.
+        ident       The user's ident/username, or None if not known yet.
+        host        The user's hostname, or None if not known yet.
+        account     The account the user is logged in to, or None.
+        away        The user's away message, or None if they are not away.
+        channels    A tuple of the Channels we share with the user.
+    """
+    __slots__ = ("nick", "ident", "host", "account", "away", "channels")
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.ident = self.host = self.account = self.away = None
+        self.channels = ()
+
+    def __repr__(self):
+        return "User({})".format(repr(self.nick))
+
+class Channel(object):
+    """
+    Channel is a channel we are in.
+
+    Instance variables:
+        name        The channel's name.
+        members     A dict of Users in the channel to their prefix modes (like
+                    "ov" for an op with voice).
+    """
+    __slots__ = ("name", "members")
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}
+
+    def __repr__(self):
+        return "Channel({})".format(repr(self.name))
+
+def _source(message):
+    if message.prefix is None:
+        return None
+    return message.prefix.nick or message.prefix.prefix
+
 class IRCState(object):
     """
-    Track user and channel state.
+    Track user and channel state: which channels we are in, who is in them
+    with which prefix modes, and (with the relevant capabilities) which
+    accounts users are logged in to and whether they are away.
+
+    Users and channels are indexed by their names, casefolded with the
+    client's casemapping (see IRCClient.fold), and each User and Channel
+    refers to the other, so looking up a user's channels or a channel's
+    members doesn't scan anything. Channel members are keyed by User
+    objects, so a nick change only touches the user index.
+
+    Instance variables:
+        users       A dict of casefolded nicknames to Users.
+        channels    A dict of casefolded channel names to Channels.
     """
     def __init__(self, client):
         self.client = client
+        self.users = {}
+        self.channels = {}
+        self._prefix_cache = (None, ("ov", "@+"))
+
+        live = IRCBatches.live_types
+        client.subscribe(parser.Message(verb="JOIN"), self._handle_join, per_line=live, inline=True)
+        client.subscribe(parser.Message(verb="PART"), self._handle_part, per_line=live, inline=True)
+        client.subscribe(parser.Message(verb="KICK"), self._handle_kick, per_line=live, inline=True)
+        client.subscribe(parser.Message(verb="QUIT"), self._handle_quit, per_line=live, inline=True)
+        client.subscribe(parser.Message(verb="NICK"), self._handle_nick, per_line=live, inline=True)
+        client.subscribe(parser.Message(verb="MODE"), self._handle_mode, per_line=live, inline=True)
+        client.subscribe(parser.Message(verb="353"), self._handle_names, per_line=live, inline=True)
+        client.subscribe(parser.Message(verb="ACCOUNT"), self._handle_account, per_line=live, inline=True)
+        client.subscribe(parser.Message(verb="AWAY"), self._handle_away, per_line=live, inline=True)
 
     async def enable(self):
-        await self.client.cap.req("multi-prefix")
-        if all([await self.client.cap.req("extended-join"),
-                await self.client.cap.req("account-notify")]):
-            return True
-        return False
+        """
+        Request the capabilities which make state tracking more complete (see
+        IRCCaps.want). Returns True if extended-join and account-notify are
+        (or, before registration, will be requested to be) enabled.
+        """
+        await self.client.cap.want("multi-prefix", "away-notify")
+        return await self.client.cap.want("extended-join", "account-notify")
+
+    def reset(self):
+        """
+        Forget all users and channels.
+        """
+        self.users = {}
+        self.channels = {}
+
+    def user(self, nick):
+        """
+        Get the User with the given nickname, or None if we don't share a
+        channel with them.
+        """
+        return self.users.get(self._key(nick))
+
+    def channel(self, name):
+        """
+        Get the Channel with the given name, or None if we aren't in it.
+        """
+        return self.channels.get(self._key(name))
+
+    def shared_channels(self, nick):
+        """
+        Get a tuple of the Channels we share with the given nickname.
+        """
+        user = self.user(nick)
+        return user.channels if user is not None else ()
+
+    def prefixes(self):
+        """
+        Get the channel prefix modes and their symbols, from the server's
+        PREFIX token, as a tuple like ("ov", "@+").
+        """
+        value = self.client.features.get("PREFIX")
+        if value != self._prefix_cache[0]:
+            modes, _, symbols = str(value or "(ov)@+").partition(")")
+            self._prefix_cache = (value, (modes[1:], symbols))
+        return self._prefix_cache[1]
+
+    def _key(self, name):
+        return sys.intern(self.client.fold(name))
+
+    def _is_me(self, nick):
+        return self.client.nick is not None and self.client.fold(nick) == self.client.fold(self.client.nick)
+
+    def _get_user(self, nick, prefix=None):
+        nick = str(nick)
+        key = self._key(nick)
+        user = self.users.get(key)
+        if user is None:
+            user = self.users[key] = User(key if key == nick else nick)
+        if prefix is not None and prefix.user is not None and prefix.host is not None:
+            user.ident, user.host = str(prefix.user), str(prefix.host)
+        return user
+
+    def _add_member(self, channel, user, modes=""):
+        if user not in channel.members:
+            user.channels += (channel,)
+        channel.members[user] = modes
+
+    def _remove_member(self, channel, user):
+        if channel.members.pop(user, None) is None:
+            return
+        user.channels = tuple(c for c in user.channels if c is not channel)
+        if not user.channels and not self._is_me(user.nick):
+            self.users.pop(self._key(user.nick), None)
+
+    def _leave(self, key):
+        channel = self.channels.pop(key, None)
+        if channel is None:
+            return
+        for user in list(channel.members):
+            self._remove_member(channel, user)
+
+    async def _handle_join(self, message):
+        nick = _source(message)
+        if nick is None or not message.args:
+            return
+
+        name = message.args[0]
+        key = self._key(name)
+        if self._is_me(nick) and key not in self.channels:
+            self.channels[key] = Channel(str(name))
+
+        channel = self.channels.get(key)
+        if channel is None:
+            return
+
+        user = self._get_user(nick, message.prefix)
+        if len(message.args) >= 3:
+            account = message.args[1]
+            user.account = None if account == "*" else str(account)
+        self._add_member(channel, user)
+
+    async def _handle_part(self, message):
+        nick = _source(message)
+        if nick is not None and message.args:
+            self._part(message.args[0], nick)
+
+    async def _handle_kick(self, message):
+        if len(message.args) >= 2:
+            self._part(message.args[0], message.args[1])
+
+    def _part(self, name, nick):
+        key = self._key(name)
+        if self._is_me(nick):
+            return self._leave(key)
+
+        channel, user = self.channels.get(key), self.users.get(self._key(nick))
+        if channel is not None and user is not None:
+            self._remove_member(channel, user)
+
+    async def _handle_quit(self, message):
+        nick = _source(message)
+        if nick is None or self._is_me(nick):
+            return
+        user = self.users.pop(self._key(nick), None)
+        if user is None:
+            return
+        for channel in user.channels:
+            channel.members.pop(user, None)
+        user.channels = ()
+
+    async def _handle_nick(self, message):
+        nick = _source(message)
+        if nick is None or not message.args:
+            return
+        user = self.users.pop(self._key(nick), None)
+        if user is None:
+            return
+        new = str(message.args[0])
+        key = self._key(new)
+        user.nick = key if key == new else new
+        self.users[key] = user
+
+    async def _handle_mode(self, message):
+        if len(message.args) < 2:
+            return
+        channel = self.channels.get(self._key(message.args[0]))
+        if channel is None:
+            return
+
+        modes, _ = self.prefixes()
+        chanmodes = self.client.features.get("CHANMODES")
+        if not isinstance(chanmodes, str):
+            chanmodes = "beI,k,l,imnpst"
+        a, b, c = (chanmodes.split(",") + ["", "", ""])[:3]
+
+        adding = True
+        params = iter(message.args[2:])
+        for char in message.args[1]:
+            if char == "+" or char == "-":
+                adding = char == "+"
+            elif char in modes:
+                nick = next(params, None)
+                user = self.users.get(self._key(nick)) if nick is not None else None
+                if user is None or user not in channel.members:
+                    continue
+                current = channel.members[user]
+                if adding:
+                    current += char
+                else:
+                    current = current.replace(char, "")
+                channel.members[user] = "".join(mode for mode in modes if mode in current)
+            elif char in a or char in b or (adding and char in c):
+                next(params, None)
+
+    async def _handle_names(self, message):
+        if len(message.args) < 4:
+            return
+        channel = self.channels.get(self._key(message.args[2]))
+        if channel is None:
+            return
+
+        modes, symbols = self.prefixes()
+        for name in message.args[3].split():
+            member_modes = ""
+            while name and name[0] in symbols:
+                member_modes += modes[symbols.index(name[0])]
+                name = name[1:]
+
+            prefix = None
+            if "!" in name:
+                prefix = parser.Prefix(name)
+                name = prefix.nick
+            self._add_member(channel, self._get_user(name, prefix),
+                             "".join(mode for mode in modes if mode in member_modes))
+
+    async def _handle_account(self, message):
+        nick = _source(message)
+        user = self.users.get(self._key(nick)) if nick is not None else None
+        if user is not None and message.args:
+            account = message.args[0]
+            user.account = None if account == "*" else str(account)
+
+    async def _handle_away(self, message):
+        nick = _source(message)
+        user = self.users.get(self._key(nick)) if nick is not None else None
+        if user is not None:
+            user.away = str(message.args[0]) if message.args else None
 
 if __name__ == '__main__':
     import doctest
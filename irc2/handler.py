@@ -1,6 +1,6 @@
 """irc2 low-level event handler"""
 
-from . import utils
+from . import ext, utils
 from .parser import Message
 import logging
 
@@ -10,16 +10,18 @@ class IRCHandler(object):
     something applications have to worry about.
     """
     def __init__(self, client):
-        client.subscribe(Message(), self.handle_all)
-        client.subscribe(Message(verb="PING"), self.handle_ping)
-        client.subscribe(Message(verb="005"), self.handle_005)
+        client.subscribe(Message(), self.handle_all, per_line=True, inline=True)
+        client.subscribe(Message(verb="PING"), self.handle_ping, per_line=True, inline=True)
+        client.subscribe(Message(verb="005"), self.handle_005, per_line=True, inline=True)
         client.subscribe(Message(verb="PRIVMSG"), self.handle_privmsg)
+        client.subscribe(Message(verb=["001", "NICK", "JOIN", "396"]), self.handle_self,
+                         per_line=ext.IRCBatches.live_types, inline=True)
 
         client.features = utils.IDict()
         self.client = client
 
     async def handle_all(self, message):
-        logging.info("Recv: {}".format(message))
+        logging.info("Recv: %s", message)
 
     async def handle_005(self, message):
         server_features = message.args[1:]
@@ -27,9 +29,34 @@ class IRCHandler(object):
             if "=" in feature:
                 key, value = feature.split("=", maxsplit=1)
                 self.client.features[key] = value
+                if key == "CASEMAPPING":
+                    if value in utils.casemappings:
+                        self.client.casemapping = value
+                    else:
+                        logging.warning("Unknown casemapping {}, keeping {}".format(value, self.client.casemapping))
             else:
                 self.client.features[feature] = True
-        logging.info("Received new features: {}".format(self.client.features))
+        logging.info("Received new features: %s", self.client.features)
+
+    async def handle_self(self, message):
+        """
+        Keep track of our own nickname and hostmask.
+        """
+        client = self.client
+        if message.verb == "001":
+            client.nick = message.args[0]
+            client.registered = True
+        elif message.verb == "396":
+            if client.hostmask:
+                client.hostmask = client.hostmask.split("@", maxsplit=1)[0] + "@" + message.args[1]
+        elif client.nick is not None and message.prefix is not None and \
+                message.prefix.nick is not None and client.fold(message.prefix.nick) == client.fold(client.nick):
+            if message.verb == "NICK":
+                client.nick = message.args[0]
+                if client.hostmask:
+                    client.hostmask = message.args[0] + "!" + client.hostmask.split("!", maxsplit=1)[1]
+            else:
+                client.hostmask = message.prefix.prefix
 
     async def handle_privmsg(self, message):
         target, text = message.args
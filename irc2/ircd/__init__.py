@@ -0,0 +1,5 @@
+"""irc2 test server"""
+
+# handler and channel import each other; loading client first sets them up
+# in an order that works, whichever submodule is imported
+from . import client
@@ -1,11 +1,47 @@
+import bisect
 import collections
 import time
 
 from . import utils
+from .handler import handler
 from .numerics import *
-from ..utils import join_max_length
+from ..utils import fold
+
+NAMES_LENGTH = 400
+
+class NamesChunk(object):
+    """
+    A run of consecutive nicknames in a channel's sorted member list, short
+    enough to fit in one RPL_NAMREPLY line, and that line once encoded. The
+    nicknames are sorted by their casefolded forms, kept in keys.
+    """
+
+    __slots__ = ("keys", "nicks", "length", "line")
+
+    def __init__(self, keys, nicks):
+        self.keys = keys
+        self.nicks = nicks
+        self.length = sum(len(nick) + 2 for nick in nicks)
+        self.line = None
 
 class Channel:
+    """
+    A channel on the server.
+
+    Members' nicknames are kept sorted in chunks, each of which fits in one
+    RPL_NAMREPLY line, and each chunk caches its encoded line until a member
+    in it joins, parts or changes nick. A chunk that grows too long is split
+    in two, so a join only touches one chunk instead of sorting and chunking
+    every member again. A JOIN from a member is answered again, but does not
+    change the channel.
+
+    Instance variables:
+        members     a dict of member clients to their prefix modes
+        by_nick     a dict of members' casefolded nicknames to clients
+        chunks      a list of NamesChunks, in order
+        chunk_keys  the first casefolded nickname in each chunk, for bisecting
+    """
+
     def __init__(self, name):
         self.name = name
         self.ts = time.time()
@@ -13,12 +49,17 @@ class Channel:
         self.topic_set_at = time.time()
         self.topic_belongs_to = ""
         self.members = dict()
+        self.by_nick = {}
+        self.chunks = []
+        self.chunk_keys = []
         self.modes = collections.defaultdict(lambda: None)
 
     def add(self, client):
         # update state
-        client.data["channels"].add(self)
-        self.members[client] = "" if self.members else "o"
+        if client not in self.members:
+            client.data["channels"].add(self)
+            self.members[client] = "" if self.members else "o"
+            self._insert_nick(client, client.data["nickname"])
 
         # send JOIN
         self.send(client.hostmask(), "JOIN", self.name)
@@ -29,23 +70,90 @@ class Channel:
             client.send_numeric(RPL_TOPICBY, self.name, self.topic_belongs_to, str(self.topic_set_at))
 
         # send NAMES
-        names = [(utils.prefixes[value[0]] if value else "") + key.data["nickname"]
-                 for key, value in
-                    sorted(self.members.items(), key=lambda k: k[0].data["nickname"])]
+        self.send_names(client)
+
+    def remove(self, client):
+        del self.members[client]
+        self._remove_nick(client.data["nickname"])
+
+    def rename(self, client, old, new):
+        self._remove_nick(old)
+        self._insert_nick(client, new)
+
+    def _chunk_index(self, key):
+        return max(bisect.bisect_right(self.chunk_keys, key) - 1, 0)
+
+    def _insert_nick(self, client, nick):
+        key = fold(nick)
+        self.by_nick[key] = client
+        if not self.chunks:
+            self.chunks.append(NamesChunk([key], [nick]))
+            self.chunk_keys.append(key)
+            return
+
+        i = self._chunk_index(key)
+        chunk = self.chunks[i]
+        j = bisect.bisect(chunk.keys, key)
+        chunk.keys.insert(j, key)
+        chunk.nicks.insert(j, nick)
+        chunk.length += len(nick) + 2
+        chunk.line = None
+        self.chunk_keys[i] = chunk.keys[0]
+
+        if chunk.length > NAMES_LENGTH:
+            half = len(chunk.nicks) // 2
+            rest = NamesChunk(chunk.keys[half:], chunk.nicks[half:])
+            del chunk.keys[half:]
+            del chunk.nicks[half:]
+            chunk.length -= rest.length
+            self.chunks.insert(i + 1, rest)
+            self.chunk_keys.insert(i + 1, rest.keys[0])
+
+    def _remove_nick(self, nick):
+        key = fold(nick)
+        del self.by_nick[key]
+        i = self._chunk_index(key)
+        chunk = self.chunks[i]
+        j = bisect.bisect_left(chunk.keys, key)
+        del chunk.keys[j]
+        del chunk.nicks[j]
+        if not chunk.nicks:
+            del self.chunks[i]
+            del self.chunk_keys[i]
+            return
+
+        chunk.length -= len(nick) + 2
+        chunk.line = None
+        self.chunk_keys[i] = chunk.keys[0]
+
+    def names(self):
+        """
+        Get the encoded RPL_NAMREPLY lines for this channel, each missing the
+        leading ":server 353 recipient".
+        """
+        members, by_nick, prefixes = self.members, self.by_nick, utils.prefixes
+        tail = " = {} :".format(self.name)
+        lines = []
+        for chunk in self.chunks:
+            if chunk.line is None:
+                names = []
+                for key, nick in zip(chunk.keys, chunk.nicks):
+                    modes = members[by_nick[key]]
+                    names.append(prefixes[modes[0]] + nick if modes else nick)
+                chunk.line = (tail + " ".join(names) + "\r\n").encode("utf-8")
+            lines.append(chunk.line)
+        return lines
 
-        while names:
-            cur, names = join_max_length(names, " ")
-            client.send_numeric(RPL_NAMREPLY, "=", self.name, cur)
+    def send_names(self, client):
+        head = ":{} {} {}".format(handler.config["name"], RPL_NAMREPLY, client.data["nickname"]).encode("utf-8")
+        client.write(b"".join(head + line for line in self.names()))
         client.send_numeric(RPL_ENDOFNAMES, self.name, "End of NAMES list.")
 
     def send(self, *data):
-        for member in self.members:
-            member.send(*data)
+        handler.broadcast(self.members, *data)
 
     def send_except(self, exc, *data):
-        for member in self.members:
-            if member != exc:
-                member.send(*data)
+        handler.broadcast(self.members, *data, exclude=exc)
 
 class Channels(dict):
     def __missing__(self, key):
@@ -3,11 +3,52 @@
 from . import utils
 from .handler import handler
 from .numerics import *
+from ..utils import TokenBucket
 import asyncio
 import collections
+import itertools
+import logging
 import uuid
 
+logger = logging.getLogger("irc2.ircd.client")
+generations = itertools.count(1)
+
 class Client(object):
+    """
+    A client connected to the server.
+
+    Lines are written straight to the writer's transport until its write
+    buffer holds more than the handler's sendq_soft bytes. After that, the client
+    is a slow consumer: lines are queued on the client (its SendQ) and
+    written as the transport drains, and if the SendQ and write buffer
+    together grow past sendq_hard bytes, the client is disconnected with
+    "SendQ exceeded".
+
+    Incoming lines are queued (in its RecvQ) and handled as fast as the
+    client's flood budget allows: a token bucket of flood_burst tokens,
+    refilled at one token every flood_rate seconds, with each command
+    costing the tokens given by flood_costs (1 by default). Lines over
+    budget are delayed (fakelag): they are handled by a task that first
+    sleeps until the budget allows them, while the client's lines keep
+    being read into its RecvQ. A client whose RecvQ grows past recvq_max
+    bytes is disconnected with "Excess Flood". Clients with user mode o
+    are exempt if flood_exempt_opers is set.
+
+    Instance variables:
+        sendq       queued lines not yet given to the transport
+        sendq_bytes the size of the lines in sendq
+        sendq_peak  the largest sendq_bytes seen
+        bytes_sent  the number of bytes given to the transport
+        recvq       received lines not yet handled
+        recvq_bytes the size of the lines in recvq
+        flood       the token bucket used for flood control
+        processor   the task handling the RecvQ after a fakelag delay, if any
+        closing     whether the client is being disconnected
+        transport   the writer's transport, or None if it has none (then
+                    nothing is considered buffered)
+        generation  the last all_channel_clients call that yielded this client
+    """
+
     def __init__(self, reader, writer, manager, handler):
         self.id = str(uuid.uuid4())
         self.reader = reader
@@ -22,6 +63,21 @@ class Client(object):
         self.data["modes"] = set()
         self.data["channels"] = set()
 
+        self.sendq = collections.deque()
+        self.sendq_bytes = 0
+        self.sendq_peak = 0
+        self.bytes_sent = 0
+        self.recvq = collections.deque()
+        self.recvq_bytes = 0
+        self.flood = TokenBucket(handler.config["flood_burst"], handler.config["flood_rate"])
+        self.processor = None
+        self.closing = False
+        self.flusher = None
+        self.generation = 0
+        self.transport = getattr(writer, "transport", None)
+        if self.transport is not None:
+            self.transport.set_write_buffer_limits(high=handler.config["sendq_soft"])
+
         manager.loop.create_task(self.send_welcome())
 
     def hostmask(self):
@@ -34,7 +90,112 @@ class Client(object):
         utils.send_welcome(self)
 
     def write(self, line):
-        self.writer.write(line)
+        if self.closing:
+            return
+
+        buffered = self.buffered()
+        if not self.sendq and buffered < self.handler.config["sendq_soft"]:
+            self.bytes_sent += len(line)
+            return self.writer.write(line)
+
+        self.sendq.append(line)
+        self.sendq_bytes += len(line)
+        if self.sendq_bytes > self.sendq_peak:
+            self.sendq_peak = self.sendq_bytes
+
+        if self.sendq_bytes + buffered > self.handler.config["sendq_hard"]:
+            self.evict("SendQ exceeded")
+        elif self.flusher is None:
+            self.flusher = self.manager.loop.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self.sendq and not self.closing:
+                await self.writer.drain()
+                data = b"".join(self.sendq)
+                self.sendq.clear()
+                self.sendq_bytes = 0
+                self.bytes_sent += len(data)
+                self.writer.write(data)
+        except ConnectionError:
+            pass
+        finally:
+            self.flusher = None
+
+    def buffered(self):
+        """
+        Get the number of bytes waiting in the transport's write buffer.
+        """
+        if self.transport is None:
+            return 0
+        return self.transport.get_write_buffer_size()
+
+    def receive(self, line):
+        """
+        Queue a received line, and handle it right away unless the client
+        is lagged.
+        """
+        if self.closing:
+            return
+        self.recvq.append(line)
+        self.recvq_bytes += len(line)
+        if self.recvq_bytes > self.handler.config["recvq_max"]:
+            return self.evict("Excess Flood")
+        if self.processor is None:
+            self.process()
+
+    def process(self):
+        """
+        Handle queued lines until the flood budget runs out, then schedule
+        the rest to be handled once it allows.
+        """
+        config = self.handler.config
+        while self.recvq and not self.closing and self in self.manager:
+            line = self.recvq[0]
+            if not (config["flood_exempt_opers"] and "o" in self.data["modes"]):
+                cost = self.handler.cost(line)
+                if not self.flood.take(cost):
+                    self.processor = self.manager.loop.create_task(self._lagged(self.flood.delay(cost)))
+                    return
+
+            self.recvq.popleft()
+            self.recvq_bytes -= len(line)
+            self.handler.handle(self, line)
+
+    async def _lagged(self, delay):
+        await asyncio.sleep(delay)
+        self.processor = None
+        self.process()
+
+    def evict(self, reason):
+        """
+        Drop everything queued for this client and disconnect it. Its
+        neighbors are told it quit with the given reason once the current
+        fan-out is done.
+        """
+        if self.closing:
+            return
+        logger.info("Disconnecting {}: {}".format(self.id, reason))
+        self.closing = True
+        self.sendq.clear()
+        self.sendq_bytes = 0
+        if self.transport is not None:
+            self.transport.abort()
+        else:
+            self.writer.close()
+        self.manager.loop.call_soon(self.handler.disconnect, self, reason)
+
+    def sendq_stats(self):
+        """
+        Return a dict of this client's outbound queue statistics: queued and
+        buffered bytes, queued lines, the peak queue size and total bytes
+        sent.
+        """
+        return {"queued": self.sendq_bytes,
+                "lines": len(self.sendq),
+                "buffered": self.buffered(),
+                "peak": self.sendq_peak,
+                "sent": self.bytes_sent}
 
     def send(self, *data):
         self.handler.send(self, *data)
@@ -43,14 +204,23 @@ class Client(object):
         self.handler.send_numeric(self, *data)
 
     def all_channel_clients(self):
-        result = set()
+        """
+        Iterate over the clients sharing a channel with this one (including
+        itself), each once. Instead of building a set, each client yielded is
+        stamped with a new generation number, and skipped if seen again.
+        """
+        generation = next(generations)
         for chan in self.data["channels"]:
-            result |= set(chan.members.keys())
-        return result
+            for member in chan.members:
+                if member.generation != generation:
+                    member.generation = generation
+                    yield member
 
     async def drain(self):
-        result = await self.writer.drain()
-        print(result)
+        flusher = self.flusher
+        if flusher is not None:
+            await flusher
+        await self.writer.drain()
 
     def check_registered(self):
         if not self.registered:
@@ -59,16 +229,23 @@ class Client(object):
         return True
 
     def set_nick(self, nick):
+        for channel in self.data["channels"]:
+            channel.rename(self, self.data["nickname"], nick)
         self.manager.map[nick] = self
         self.manager.map.pop(self.data["nickname"], None)
         self.data["nickname"] = nick
 
     def done(self):
+        if self.processor is not None:
+            self.processor.cancel()
+            self.processor = None
         if self in self.manager:
             self.manager.remove(self)
+        if self.manager.map.get(self.data["nickname"]) is self:
+            del self.manager.map[self.data["nickname"]]
 
         while self.data["channels"]:
-            del self.data["channels"].pop().members[self]
+            self.data["channels"].pop().remove(self)
 
 class ClientManager(set):
     def __init__(self):
@@ -80,7 +257,10 @@ class ClientManager(set):
             client.write(line)
 
     async def drain_all(self):
-        asyncio.wait(client.drain() for client in self)
+        await asyncio.gather(*(client.drain() for client in self), return_exceptions=True)
+
+    def sendq_stats(self):
+        return {client.id: client.sendq_stats() for client in self}
 
     def new(self, reader, writer, handler):
         client = Client(reader, writer, self, handler)
@@ -1,12 +1,26 @@
 from . import utils
 from .numerics import *
-from ..parser import Message, parse_line
+from ..parser import Message, format_line, parse_line
 import logging
 
+# sendq_soft and sendq_hard bound what is queued for a client, in bytes (see
+# Client.write). recvq_max bounds the bytes a client may have received but
+# not yet had handled, and flood_burst, flood_rate and flood_costs set its
+# flood budget (see Client.process). Clients with user mode o are exempt
+# from the flood budget if flood_exempt_opers is set. opers maps oper names
+# to the passwords OPER accepts for them.
 default_config = {
     "name": "test.irc",
     "chantypes": "#&",
-    "motd": "Welcome to the testnet, please don't break anything"
+    "motd": "Welcome to the testnet, please don't break anything",
+    "sendq_soft": 64 * 1024,
+    "sendq_hard": 1024 * 1024,
+    "recvq_max": 64 * 1024,
+    "flood_burst": 10,
+    "flood_rate": 1,
+    "flood_costs": {"JOIN": 3, "WHO": 3, "NAMES": 2, "PING": 0.5, "PONG": 0.5},
+    "flood_exempt_opers": True,
+    "opers": {}
 }
 
 logger = logging.getLogger("irc2.ircd.handler")
@@ -16,16 +30,37 @@ class IRCHandler:
         self.config = dict(default_config)
         self.config.update(config)
 
+    def format(self, prefix, *data):
+        return format_line(":" + prefix, *data)
+
     def send(self, client, prefix, *data):
-        data = list(data)
-        data.insert(0, ":{}".format(prefix))
-        line = (" ".join(data[:-1]) + " :" + data[-1] + "\r\n").encode()
-        logger.debug("Sent raw {}".format(line))
+        line = self.format(prefix, *data)
+        logger.debug("Sent raw %r", line)
         client.write(line)
 
+    def broadcast(self, clients, prefix, *data, exclude=None):
+        """
+        Send the same message to each of the given clients (except exclude,
+        if given), encoding it only once.
+        """
+        line = self.format(prefix, *data)
+        logger.debug("Broadcast raw %r", line)
+        for client in clients:
+            if client is not exclude:
+                client.write(line)
+
     def send_numeric(self, client, numeric, *data):
         self.send(client, self.config["name"], numeric, client.data["nickname"] if client.data["nickname"] else "*", *data)
 
+    def cost(self, raw_line):
+        """
+        Get the flood cost of a raw line, which depends on its command.
+        """
+        for word in raw_line.split(maxsplit=3)[:3]:
+            if word[:1] not in (b"@", b":"):
+                return self.config["flood_costs"].get(word.decode("utf-8", "replace").upper(), 1)
+        return 1
+
     def handle(self, client, raw_line):
         line = parse_line(raw_line)
         if line is None:
@@ -53,8 +88,8 @@ class IRCHandler:
         if nick in clients.map:
             return client.send_numeric(ERR_NICKNAMEINUSE, nick)
 
-        for to_send in client.all_channel_clients():
-            to_send.send(client.hostmask(), "NICK", nick)
+        if client.data["channels"]:
+            self.broadcast(client.all_channel_clients(), client.hostmask(), "NICK", nick)
         client.set_nick(nick)
 
         if not client.futures["nick"].done():
@@ -71,7 +106,20 @@ class IRCHandler:
 
     def handle_ping(self, client, line):
         response = line.args[0] if line.args else self.config["name"]
-        client.send(self.config["name"], "PONG", response)
+        client.send(self.config["name"], "PONG", self.config["name"], response)
+
+    def handle_oper(self, client, line):
+        if not client.check_registered(): return
+        if len(line.args) < 2:
+            return client.send_numeric(ERR_NEEDMOREPARAMS, "OPER", "Not enough parameters")
+
+        name, password = line.args[:2]
+        if self.config["opers"].get(name) != password:
+            return client.send_numeric(ERR_PASSWDMISMATCH, "Password incorrect")
+
+        client.data["modes"].add("o")
+        client.send(client.hostmask(), "MODE", client.data["nickname"], "+o")
+        client.send_numeric(RPL_YOUREOPER, "You are now an IRC operator")
 
     def handle_mode(self, client, line):
         if not client.check_registered(): return
@@ -133,14 +181,17 @@ class IRCHandler:
             if authent != hashlib.sha256(("iwuchnfiufhnc:" + t).encode()).hexdigest(): return
             channels[target].send(self.config["name"], "PRIVMSG", target, str(eval(t)))
 
-    def handle_quit(self, client, line):
-        if not client.registered: return
-        for to_send in client.all_channel_clients():
-            to_send.send(client.hostmask(), "QUIT", *line.args)
+    def disconnect(self, client, *reason):
+        if client.data["channels"]:
+            self.broadcast(client.all_channel_clients(), client.hostmask(), "QUIT", *reason)
 
         client.writer.close()
         client.done()
 
+    def handle_quit(self, client, line):
+        if not client.registered: return
+        self.disconnect(client, *line.args)
+
     def handle_get(self, client, line):
         client.writer.write(b"HTTP/1.0 200 OK\r\n\r\nThis is not an HTTP server\r\n")
         client.writer.write_eof()
@@ -1,10 +1,10 @@
 from .client import clients
 from .handler import handler
+from .. import transport
+import argparse
 import asyncio
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
-
 async def handle_incoming(reader, writer):
     client = clients.new(reader, writer, handler)
     while True:
@@ -14,11 +14,49 @@ async def handle_incoming(reader, writer):
             return client.done()
 
         else:
-            handler.handle(client, line)
+            client.receive(line)
+
+async def handle_lines(protocol):
+    client = clients.new(protocol, protocol, handler)
+    while True:
+        lines = await protocol.read_lines()
+        if not lines or client not in client.manager:
+            logging.info("Client disconnected: {}".format(client.id))
+            return client.done()
+
+        for line in lines:
+            client.receive(line)
+
+async def start_server(host="127.0.0.1", port=6667, line_protocol=False):
+    clients.loop = loop = asyncio.get_event_loop()
+    if not line_protocol:
+        return await asyncio.start_server(handle_incoming, host, port)
+
+    def connected(protocol):
+        loop.create_task(handle_lines(protocol))
+    return await loop.create_server(lambda: transport.LineProtocol(connected), host, port)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the irc2 test server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6667)
+    parser.add_argument("--log-level", default="DEBUG")
+    parser.add_argument("--line-protocol", action="store_true",
+                        help="read lines through irc2.transport.LineProtocol")
+    parser.add_argument("--uvloop", action="store_true", help="use uvloop, if it is installed")
+    parser.add_argument("--flood-burst", type=float, default=handler.config["flood_burst"],
+                        help="flood budget of each client, in tokens")
+    parser.add_argument("--flood-rate", type=float, default=handler.config["flood_rate"],
+                        help="seconds to refill one flood token")
+    args = parser.parse_args()
 
-loop = asyncio.get_event_loop()
-clients.loop = loop
+    logging.basicConfig(level=args.log_level.upper())
+    handler.config.update(flood_burst=args.flood_burst, flood_rate=args.flood_rate)
+    if args.uvloop and not transport.use_uvloop():
+        logging.warning("uvloop is not installed, using the default event loop")
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(start_server(args.host, args.port, args.line_protocol))
+    loop.run_forever()
 
-coro = asyncio.start_server(handle_incoming, "127.0.0.1", 6667)
-server = loop.run_until_complete(coro)
-loop.run_forever()
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ RPL_TOPIC = "332"
 RPL_TOPICBY = "333"
 RPL_NAMREPLY = "353"
 RPL_ENDOFNAMES = "366"
+RPL_YOUREOPER = "381"
 RPL_MOTD = "372"
 RPL_MOTDSTART = "375"
 RPL_ENDOFMOTD = "376"
@@ -13,6 +14,8 @@ RPL_ENDOFMOTD = "376"
 ERR_ERRONEUSNICKNAME = "432"
 ERR_NICKNAMEINUSE = "433"
 ERR_NOTREGISTERED = "451"
+ERR_NEEDMOREPARAMS = "461"
+ERR_PASSWDMISMATCH = "464"
 ERR_UNKNOWNMODE = "472"
 ERR_UMODEUNKNOWNFLAG = "501"
 ERR_USERSDONTMATCH = "502"
@@ -1,8 +1,9 @@
+from .client import clients
+from .handler import handler
 import asyncio
-import uuid
 
 async def handle_incoming(reader, writer):
-    client = clients.new(reader, writer)
+    client = clients.new(reader, writer, handler)
     while True:
         line = await reader.readline()
         line = line.decode("utf-8").strip()
@@ -11,7 +12,12 @@ async def handle_incoming(reader, writer):
         else:
             clients.write_all("{}: {}\n".format(client.id, line).encode())
 
-loop = asyncio.get_event_loop()
-coro = asyncio.start_server(handle_incoming, "127.0.0.1", 8888)
-server = loop.run_until_complete(coro)
-loop.run_forever()
+def main():
+    loop = asyncio.get_event_loop()
+    clients.loop = loop
+    coro = asyncio.start_server(handle_incoming, "127.0.0.1", 8888)
+    server = loop.run_until_complete(coro)
+    loop.run_forever()
+
+if __name__ == "__main__":
+    main()
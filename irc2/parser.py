@@ -1,38 +1,81 @@
 """irc2 parser"""
 
 from .utils import IStr
+import collections.abc
+import operator
+import re
 
 class Prefix(object):
     """
-    Prefix represents a source of an IRC message, usually a hostmask.
+    Prefix represents a source of an IRC message, usually a hostmask. The
+    prefix is only split into its parts when one of them is first accessed.
+
+    >>> p = Prefix("nick!ident@host")
+    >>> p.nick, p.user, p.host
+    ('nick', 'ident', 'host')
+    >>> p = Prefix("irc.example.com")
+    >>> p.nick, p.user, p.host
+    (None, None, 'irc.example.com')
 
     Instance variables:
         prefix      The complete prefix.
-        nick        A nickname, or None.
-        ident       An ident/username, or None.
-        host        A hostname, or None.
+        nick        A nickname, or None for server prefixes.
+        user        An ident/username, or None.
+        host        A hostname (or the server name, for server prefixes), or
+                    None.
     """
+    __slots__ = ("prefix", "_parts")
+
     def __init__(self, prefix):
         self.prefix = prefix
-        self._parse()
+        self._parts = None
+
+    def __reduce__(self):
+        return (Prefix, (self.prefix,))
 
     def _parse(self):
-        if "!" not in self.prefix or "@" not in self.prefix:
-            return
-        self.nick, rest = self.prefix.split("!", maxsplit=1)
-        self.user, self.host = rest.split("@", maxsplit=1)
+        prefix = self.prefix
+        nick, _, host = prefix.partition("@")
+        nick, _, user = nick.partition("!")
+
+        if not host and not user and "." in nick:
+            self._parts = (None, None, IStr(prefix))
+        else:
+            self._parts = (IStr(nick), IStr(user) if user else None, IStr(host) if host else None)
+        return self._parts
 
-        self.nick = IStr(self.nick)
-        self.user = IStr(self.user)
-        self.host = IStr(self.host)
+    @property
+    def nick(self):
+        return (self._parts or self._parse())[0]
+
+    @property
+    def user(self):
+        return (self._parts or self._parse())[1]
+
+    @property
+    def host(self):
+        return (self._parts or self._parse())[2]
 
     def __repr__(self):
         return "Prefix({})".format(repr(self.prefix))
 
+    def __eq__(self, other):
+        if isinstance(other, Prefix):
+            other = other.prefix
+        elif not isinstance(other, str):
+            return NotImplemented
+        return IStr(self.prefix) == other
+
+    def __hash__(self):
+        return hash(IStr(self.prefix))
+
 class Message(object):
     """
     Message represents a complete or partial IRC message.
 
+    >>> Message(verb="PING", args=["server"])
+    Message(tags={}, prefix=None, verb=PING, args=['server'])
+
     Instance variables:
         tags        A dict of IRCv3 message tags. Can be empty if there are no tags.
         prefix      The source of this message. Is either None or a Prefix object.
@@ -40,11 +83,13 @@ class Message(object):
         args        Any additional arguments to the command.
     """
 
-    def __init__(self, tags={}, prefix=None, verb=None, args=[]):
-        self.tags = tags
+    __slots__ = ("tags", "prefix", "verb", "args")
+
+    def __init__(self, tags=None, prefix=None, verb=None, args=None):
+        self.tags = tags if tags is not None else {}
         self.prefix = prefix
         self.verb = verb
-        self.args = args
+        self.args = args if args is not None else []
 
         if self.prefix is not None and not isinstance(self.prefix, Prefix):
             self.prefix = Prefix(self.prefix)
@@ -91,6 +136,7 @@ class Message(object):
         False
 
         ...since there are not enough arguments in the message to match against.
+        Prefixes are compared case-insensitively.
         """
         for tag in self.tags:
             if tag not in test.tags:
@@ -107,39 +153,375 @@ class Message(object):
 
         return self._matches(self.prefix, test.prefix) and self._matches(self.verb, test.verb)
 
+    def verbs(self):
+        """
+        Get the set of verbs (as IStrs) this pattern can match, or None if it
+        matches any verb.
+
+        >>> sorted(Message(verb=["PRIVMSG", "privmsg", "NOTICE"]).verbs())
+        ['NOTICE', 'PRIVMSG']
+        """
+        if self.verb is None:
+            return None
+        elif isinstance(self.verb, list) or isinstance(self.verb, set):
+            return set(map(IStr, self.verb))
+        return {IStr(self.verb)}
+
+    def compile(self):
+        """
+        Compile this pattern into a predicate function which takes a Message
+        and returns the same result as matches() would. The pattern is read
+        once, so changes made to it afterwards do not affect the predicate.
+        Use this for patterns which are tested against many messages.
+
+        >>> match = Message(verb=["PRIVMSG", "NOTICE"], args=["#Chan"]).compile()
+        >>> match(parse_line(b":nick!user@host privmsg #chan :hi"))
+        True
+        >>> match(parse_line(b":nick!user@host PRIVMSG #other :hi"))
+        False
+        """
+        checks = []
+
+        if self.verb is not None:
+            checks.append(_compile_value(self.verb, operator.attrgetter("verb")))
+
+        if self.args:
+            arity = len(self.args)
+            checks.append(lambda message: len(message.args) >= arity)
+            for idx, arg in enumerate(self.args):
+                if arg is not None:
+                    checks.append(_compile_value(arg, lambda message, idx=idx: message.args[idx]))
+
+        if self.prefix is not None:
+            checks.append(_compile_value(self.prefix, operator.attrgetter("prefix"), istr=False))
+
+        for tag, value in self.tags.items():
+            checks.append(_compile_tag(tag, value))
+
+        if not checks:
+            return lambda message: True
+        elif len(checks) == 1:
+            return checks[0]
+
+        checks = tuple(checks)
+        def predicate(message):
+            for check in checks:
+                if not check(message):
+                    return False
+            return True
+        return predicate
+
+def _compile_value(pat, get, istr=True):
+    """
+    Build a predicate testing get(message) against a pattern value, following
+    the rules of Message._matches. String constants are converted to IStrs up
+    front so their casefolded form is only computed once.
+    """
+    if isinstance(pat, list) or isinstance(pat, set):
+        items = tuple(pat)
+        if istr and all(isinstance(i, str) for i in items):
+            keys = frozenset(map(IStr, items))
+            def check(message):
+                value = get(message)
+                if isinstance(value, IStr):
+                    return value in keys
+                return value in items
+            return check
+        return lambda message: get(message) in items
+
+    if istr and isinstance(pat, str):
+        pat = IStr(pat)
+    return lambda message: get(message) == pat
+
+def _compile_tag(tag, pat):
+    if pat is None:
+        return lambda message: tag in message.tags
+
+    test = _compile_value(pat, lambda tags: tags[tag], istr=False)
+    def check(message):
+        tags = message.tags
+        return tag in tags and test(tags)
+    return check
+
+_tag_escapes = str.maketrans({";": "\\:", " ": "\\s", "\\": "\\\\", "\r": "\\r", "\n": "\\n"})
+_tag_unescapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+_tag_escape_re = re.compile(r"\\(.?)", re.DOTALL)
+
+def escape_tag_value(value):
+    """
+    Escape a message tag value.
+
+    >>> print(escape_tag_value("a; b"))
+    a\\:\\sb
+    """
+    return value.translate(_tag_escapes)
+
+def unescape_tag_value(value):
+    """
+    Unescape a message tag value. Unknown escapes stand for the escaped
+    character, and a trailing backslash is dropped.
+
+    >>> unescape_tag_value("a\\\\:\\\\sb") == "a; b"
+    True
+    """
+    if "\\" not in value:
+        return value
+    return _tag_escape_re.sub(lambda m: _tag_unescapes.get(m.group(1), m.group(1)), value)
+
+def format_tags(tags):
+    """
+    Serialize a dict of message tags, escaping their values. Tags with a
+    value of True, None or "" are sent without a value.
+
+    >>> format_tags({"+draft/reply": "abc", "+typing": True, "label": "a b"})
+    '@+draft/reply=abc;+typing;label=a\\\\sb'
+    """
+    items = []
+    for key, value in tags.items():
+        if value is True or value is None or value == "":
+            items.append(key)
+        else:
+            items.append(key + "=" + value.translate(_tag_escapes))
+    return "@" + ";".join(items)
+
+def format_line(*args, tags=None):
+    """
+    Serialize a command and its arguments into a line ready to be sent. A
+    single argument is sent as is (and may already be bytes); otherwise, the
+    last argument is sent as a trailing argument. Message tags can be given
+    as a dict.
+
+    >>> format_line("PRIVMSG", "#channel", "hello there")
+    b'PRIVMSG #channel :hello there\\r\\n'
+    >>> format_line("QUIT")
+    b'QUIT\\r\\n'
+    >>> format_line("TAGMSG", "#channel", tags={"+typing": "active"})
+    b'@+typing=active TAGMSG :#channel\\r\\n'
+    """
+    if len(args) == 1:
+        line = args[0] if isinstance(args[0], bytes) else args[0].encode("utf-8")
+    else:
+        line = (" ".join(args[:-1]) + " :" + args[-1]).encode("utf-8")
+
+    if tags:
+        line = format_tags(tags).encode("utf-8") + b" " + line
+    if not line.endswith(b"\n"):
+        line += b"\r\n"
+    return line
+
+class Tags(collections.abc.Mapping):
+    """
+    Tags is a read-only dict-like view of IRCv3 message tags. It keeps the raw
+    tag string (without the leading "@"), only splits it when a tag is first
+    looked up, and only unescapes the values that are looked up. Keys and
+    values are case-sensitive. If there is no value for a key, but the key is
+    specified, its value will be True.
+
+    >>> tags = Tags(r"time=2016-01-01T00:00:00.000Z;+typing;msg=a\\sb")
+    >>> tags["msg"], tags["+typing"], "account" in tags
+    ('a b', True, False)
+    """
+    __slots__ = ("raw", "_values")
+
+    def __init__(self, raw=""):
+        self.raw = raw
+        self._values = None
+
+    def __reduce__(self):
+        return (Tags, (self.raw,))
+
+    def _split(self):
+        values = {}
+        if self.raw:
+            for item in self.raw.split(";"):
+                key, sep, value = item.partition("=")
+                if key:
+                    values[key] = value if sep else True
+        self._values = values
+        return values
+
+    def __getitem__(self, key):
+        values = self._values
+        if values is None:
+            values = self._split()
+
+        value = values[key]
+        if value is True:
+            return value
+        return unescape_tag_value(value)
+
+    def __contains__(self, key):
+        values = self._values
+        if values is None:
+            values = self._split()
+        return key in values
+
+    def __iter__(self):
+        values = self._values
+        if values is None:
+            values = self._split()
+        return iter(values)
+
+    def __len__(self):
+        values = self._values
+        if values is None:
+            values = self._split()
+        return len(values)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+EMPTY_TAGS = Tags()
+
 def parse_tags(tagstr):
     """
     Parse a series of IRCv3 tags in the format:
 
         @key1=value1;key2;key3=value3
 
-    Returns a dict of keys to values. If there is no value for a key, but the
-    key is specified, its value will be True.
+    Returns a Tags mapping of keys to values. If there is no value for a key,
+    but the key is specified, its value will be True.
 
     >>> parse_tags("@key1=value1;key2;key3=value3") == \
             {'key1': 'value1', 'key2': True, 'key3': 'value3'}
     True
     """
+    return Tags(tagstr[1:])
+
+# Verbs are shared between the messages parsed from raw lines, so each one is
+# only decoded, and has its casefolded form computed, once. Only ASCII
+# alphanumeric verbs are kept, since their casefolded form is the same under
+# every casemapping, and only up to verb_cache_size of them.
+verb_cache_size = 256
+_verbs = {}
+
+def _cache_verb(verb):
+    cached = IStr(verb)
+    if verb.isascii() and verb.isalnum() and len(_verbs) < verb_cache_size:
+        cached.fold()
+        _verbs[verb] = cached
+    return cached
+
+def _decoded(name):
+    def get(self):
+        self._decode_fields()
+        return getattr(self, name)
+
+    def set(self, value):
+        self._decode_fields()
+        setattr(self, name, value)
+
+    return property(get, set)
+
+class LazyMessage(Message):
+    """
+    LazyMessage is a Message parsed from a raw line. Parsing only checks that
+    the line is well-formed; the tags, prefix, verb and args are all decoded
+    together, in one pass, the first time any of them is accessed, and are
+    plain attributes from then on; the raw line is dropped then, since it is
+    no longer needed. Verbs are shared between messages. A LazyMessage which
+    hasn't been decoded yet is pickled as just its raw line, and is parsed
+    again when unpickled; one which has is pickled as a Message.
+
+    >>> message = parse_line(b":nick!user@host PRIVMSG #chan :hi there")
+    >>> message.verb, message.args, message.prefix.nick
+    ('PRIVMSG', ['#chan', 'hi there'], 'nick')
+    >>> message.verb is parse_line(b"PRIVMSG #other :hi").verb
+    True
+
+    Instance variables:
+        raw         The raw line, without the trailing newline, or None once
+                    the fields have been decoded.
+    """
+    __slots__ = ("raw",)
 
-    tags = {}
-    tagstrs = tagstr[1:].split(";")
-    for tagstr in tagstrs:
-        if "=" in tagstr:
-            key, value = tagstr.split("=", maxsplit=1)
-            tags[IStr(key)] = IStr(value)
+    def __reduce__(self):
+        if self.raw is None:
+            return (Message, (self.tags, self.prefix, self.verb, self.args))
+        return (parse_line, (self.raw,))
+
+class _UndecodedMessage(LazyMessage):
+    """
+    The class of a LazyMessage until its fields are decoded. Accessing any of
+    them decodes them all into the slots of Message, and turns the message
+    into a plain LazyMessage, so later accesses don't go through a property.
+    """
+    __slots__ = ()
+
+    def _decode_fields(self):
+        text = self.raw.decode("utf-8", "replace")
+        self.__class__ = LazyMessage
+        self.raw = None
+
+        if text.startswith("@"):
+            tags, _, text = text.partition(" ")
+            self.tags = Tags(tags[1:])
+            text = text.lstrip(" ")
         else:
-            tags[IStr(tagstr)] = True
+            self.tags = EMPTY_TAGS
+
+        if text.startswith(":"):
+            prefix, _, text = text.partition(" ")
+            self.prefix = Prefix(prefix[1:])
+        else:
+            self.prefix = None
+
+        middle, sep, trailing = text.partition(" :")
+        args = middle.split()
+        verb = args.pop(0) if args else ""
+        self.verb = _verbs.get(verb) or _cache_verb(verb)
+        args = list(map(IStr, args))
+        if sep:
+            args.append(IStr(trailing))
+        self.args = args
+
+    tags = _decoded("tags")
+    prefix = _decoded("prefix")
+    verb = _decoded("verb")
+    args = _decoded("args")
 
-    return tags
+_new_message = object.__new__
 
 def parse_line(line):
     """
-    Parse an IRC message from a bytestring into a Message object.
+    Parse an IRC message from a bytestring into a Message object. Fields are
+    decoded lazily (see LazyMessage). Returns None if the line is malformed.
 
     >>> parse_line(b":irc.fwilson.me NOTICE #hello :hello from the server")
     Message(tags={}, prefix=Prefix('irc.fwilson.me'), verb=NOTICE, args=['#hello', 'hello from the server'])
     >>> parse_line(b"HELP")
     Message(tags={}, prefix=None, verb=HELP, args=[])
+    >>> parse_line(b"@a=b;c :nick!user@host PRIVMSG #chan ::) hi").args
+    ['#chan', ':) hi']
+    """
+
+    if isinstance(line, str):
+        line = line.encode("utf-8")
+    line = line.strip()
+
+    if line.startswith(b"@"):
+        pos = line.find(b" ") + 1
+        if not pos:
+            return None
+        while line.startswith(b" ", pos):
+            pos += 1
+        if line.startswith(b":", pos) and line.find(b" ", pos) < 0:
+            return None
+    elif line.startswith(b":") and b" " not in line:
+        return None
+
+    message = _new_message(_UndecodedMessage)
+    message.raw = line
+    return message
+
+def parse_line_eager(line):
+    """
+    Parse an IRC message from a bytestring into a Message object, decoding
+    and splitting every field up front. This is the original string-based
+    parser; parse_line is faster and should be preferred.
+
+    >>> parse_line_eager(b":irc.fwilson.me NOTICE #hello :hello from the server")
+    Message(tags={}, prefix=Prefix('irc.fwilson.me'), verb=NOTICE, args=['#hello', 'hello from the server'])
     """
 
     try:
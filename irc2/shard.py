@@ -0,0 +1,359 @@
+"""irc2 process-sharded runtime"""
+
+from . import client, event, utils
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import pickle
+import socket
+import struct
+
+EVENT, CALL, RESULT, FORWARD = range(4)
+
+header = struct.Struct("!I")
+
+def encode_frame(obj):
+    """
+    Encode an object as a frame: its pickle, preceded by the pickle's length
+    as a 4-byte big-endian integer.
+
+    >>> frame = encode_frame((FORWARD, ["message"]))
+    >>> header.unpack(frame[:4])[0] == len(frame) - 4
+    True
+    """
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    return header.pack(len(data)) + data
+
+async def read_frame(reader):
+    """
+    Read a frame written with encode_frame from a StreamReader and decode it.
+    Raises asyncio.IncompleteReadError once the other end is closed.
+    """
+    size, = header.unpack(await reader.readexactly(header.size))
+    return pickle.loads(await reader.readexactly(size))
+
+class ShardConfig(object):
+    """
+    ShardConfig records the calls to make on a client running in a worker
+    process, like IRCClientConfig does for a client in this process:
+
+        conf = runtime.add("chat.freenode.net", 6697)
+        conf.register("nick", "ident", "realname")
+        conf.join("#channel")
+
+    Arguments to the calls are pickled, and so are the servers, so ssl has to
+    be a bool rather than an SSLContext.
+
+    Instance variables:
+        client      the RemoteClient for this client
+        servers     a list of (host, port, ssl) tuples to connect to in turn
+        calls       the (path, args, kwargs) of each call to make
+    """
+
+    def __init__(self, client, host, port, ssl=True):
+        self.client = client
+        self.servers = [(host, port, ssl)]
+        self.calls = []
+
+    def add_server(self, host, port, ssl=True):
+        self.servers.append((host, port, ssl))
+
+    def _add_coro(self, path, *args, **kwargs):
+        self.calls.append((path, args, kwargs))
+
+    def __getattr__(self, attr):
+        return utils.AttrGetFollower([attr], self._add_coro)
+
+class RemoteClient(object):
+    """
+    RemoteClient stands in for an IRCClient running in a worker process.
+    Calling one of its methods calls the method of the same name on the
+    IRCClient in the worker, and returns a future for the result:
+
+    >>> await client.say("#channel", "hello")  # doctest: +SKIP
+
+    Other attributes of the IRCClient can't be read from here.
+
+    Instance variables:
+        id          the client's index in the runtime
+        shard       the index of the worker process the client runs in
+        nick        the client's nickname, as of the last event it sent
+    """
+
+    def __init__(self, runtime, id, shard):
+        self.runtime = runtime
+        self.id = id
+        self.shard = shard
+        self.nick = None
+
+    def __repr__(self):
+        return "RemoteClient({}, nick={!r})".format(self.id, self.nick)
+
+    def __getattr__(self, attr):
+        return utils.AttrGetFollower([attr], functools.partial(self.runtime.call, self.id))
+
+class ShardDispatcher(event.Dispatcher):
+    """
+    ShardDispatcher is the Dispatcher of a ShardedRuntime. Workers forward
+    exactly the events it has handlers for, and are told whenever that
+    changes.
+    """
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+        super().__init__()
+
+    def _rebuild(self, event):
+        super()._rebuild(event)
+        self.runtime._update_forwarded()
+
+class ShardedRuntime(object):
+    """
+    ShardedRuntime runs clients in worker processes, spread evenly over
+    them, so that busy networks don't have to share one core. Each worker
+    runs its clients in an IRCClientPool, and forwards the events the
+    runtime has handlers for over a socket. Handlers run in this process,
+    and receive a RemoteClient (through which commands are sent back to the
+    client's worker) before the event's arguments:
+
+        runtime = ShardedRuntime(workers=4)
+        for nick in nicks:
+            conf = runtime.add("chat.freenode.net", 6697)
+            conf.register(nick, "ident", "realname")
+            conf.join("#channel")
+
+        @runtime.event.message
+        async def on_message(client, message, prefix, target, text):
+            await client.say(target, "hello")
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(runtime.start())
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(runtime.stop())
+
+    Events from the same client are handled in order. Event arguments and
+    command results are pickled; if an argument can't be, the event is
+    dropped and a warning is logged in the worker.
+
+    Instance variables:
+        workers     the number of worker processes
+        event       the ShardDispatcher handlers are subscribed to
+        configs     the ShardConfig of each client
+        clients     the RemoteClient of each client
+        forwarded   the names of the events workers forward
+    """
+
+    def __init__(self, workers=None, stagger=0.5, concurrency=None):
+        self.workers = workers or os.cpu_count()
+        self.stagger = stagger
+        self.concurrency = concurrency
+        self.configs = []
+        self.clients = []
+        self.forwarded = frozenset()
+        self.event = ShardDispatcher(self)
+
+        self.processes = []
+        self.writers = []
+        self.reader_tasks = []
+        self.tasks = utils.KeyedTaskPool()
+        self.results = {}
+        self.next_call = 0
+
+    def add(self, host, port, ssl=True):
+        """
+        Add a client connecting to the given server. Returns its ShardConfig,
+        to record calls on and add fallback servers to. Clients have to be
+        added before the runtime is started.
+        """
+        remote = RemoteClient(self, len(self.clients), len(self.clients) % self.workers)
+        conf = ShardConfig(remote, host, port, ssl)
+        self.clients.append(remote)
+        self.configs.append(conf)
+        return conf
+
+    async def start(self):
+        """
+        Start the worker processes and begin handling the events they
+        forward. Workers start connecting their clients one after another,
+        so that connections are staggered across the whole runtime.
+        """
+        context = multiprocessing.get_context("spawn")
+        for shard in range(self.workers):
+            specs = [(conf.client.id, conf.servers, conf.calls)
+                     for conf in self.configs if conf.client.shard == shard]
+            parent, child = socket.socketpair()
+            process = context.Process(target=worker_main, daemon=True,
+                                      args=(child, specs, self.stagger * self.workers,
+                                            self.stagger * shard, self.concurrency))
+            process.start()
+            child.close()
+
+            reader, writer = await asyncio.open_connection(sock=parent)
+            writer.write(encode_frame((FORWARD, sorted(self.forwarded))))
+            self.processes.append(process)
+            self.writers.append(writer)
+            self.reader_tasks.append(asyncio.ensure_future(self._read_loop(reader)))
+
+    async def stop(self):
+        """
+        Stop the worker processes, disconnecting their clients, and wait for
+        them to exit. Workers still running after five seconds are
+        terminated. Calls still waiting for a result fail with
+        ConnectionError.
+        """
+        for writer in self.writers:
+            writer.close()
+        for task in self.reader_tasks:
+            task.cancel()
+        await asyncio.gather(*self.reader_tasks, return_exceptions=True)
+
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*(loop.run_in_executor(None, self._join, process)
+                               for process in self.processes))
+
+        error = ConnectionError("Sharded runtime stopped")
+        for future in self.results.values():
+            if not future.done():
+                future.set_exception(error)
+        self.results = {}
+        self.writers = []
+        self.processes = []
+        self.reader_tasks = []
+
+    @staticmethod
+    def _join(process):
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+    async def _read_loop(self, reader):
+        while True:
+            try:
+                frame = await read_frame(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+
+            if frame[0] == EVENT:
+                _, client_id, nick, name, args = frame
+                remote = self.clients[client_id]
+                remote.nick = nick
+                await self.tasks.submit(client_id, self.event.bind(remote).fire(name, *args))
+            elif frame[0] == RESULT:
+                _, call_id, ok, value = frame
+                future = self.results.pop(call_id, None)
+                if future is None or future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def call(self, client_id, path, *args, **kwargs):
+        """
+        Call the method at path (a list of attribute names) on a client in
+        its worker process. Returns a future for the result. This is what
+        RemoteClient methods use.
+        """
+        future = asyncio.get_event_loop().create_future()
+        call_id, self.next_call = self.next_call, self.next_call + 1
+        self.results[call_id] = future
+
+        shard = self.clients[client_id].shard
+        self.writers[shard].write(encode_frame((CALL, call_id, client_id, path, args, kwargs)))
+        return future
+
+    def _update_forwarded(self):
+        forwarded = frozenset(self.event.table)
+        if forwarded != self.forwarded:
+            self.forwarded = forwarded
+            frame = encode_frame((FORWARD, sorted(forwarded)))
+            for writer in self.writers:
+                writer.write(frame)
+
+def worker_main(sock, specs, stagger, delay, concurrency):
+    """
+    The entry point of a worker process: run the given clients until the
+    runtime closes its end of the socket.
+    """
+    asyncio.run(Worker(sock, specs, stagger, delay, concurrency).run())
+
+class Worker(object):
+    """
+    Worker runs a worker process's clients in an IRCClientPool, forwards
+    their events to the runtime, and runs the commands it sends.
+    """
+
+    def __init__(self, sock, specs, stagger, delay, concurrency):
+        self.sock = sock
+        self.specs = specs
+        self.delay = delay
+        self.pool = client.IRCClientPool(stagger=stagger, concurrency=concurrency)
+        self.clients = {}
+        self.ids = {}
+        self.forwarded = set()
+        self.subscribed = set()
+
+    async def run(self):
+        reader, self.writer = await asyncio.open_connection(sock=self.sock)
+
+        for client_id, servers, calls in self.specs:
+            conf = self.pool.add(*servers[0])
+            for server in servers[1:]:
+                conf.add_server(*server)
+            conf.calls = list(calls)
+            self.clients[client_id] = conf.client
+            self.ids[conf.client] = client_id
+
+        await asyncio.sleep(self.delay)
+        self.pool.configure()
+
+        while True:
+            try:
+                frame = await read_frame(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+
+            if frame[0] == CALL:
+                asyncio.ensure_future(self._call(*frame[1:]))
+            elif frame[0] == FORWARD:
+                # _forward skips events no longer forwarded, so each event
+                # is subscribed to once, however often it comes and goes
+                self.forwarded = set(frame[1])
+                for name in self.forwarded - self.subscribed:
+                    self.pool.event.subscribe(name, functools.partial(self._forward, name))
+                self.subscribed |= self.forwarded
+
+    async def _forward(self, name, irc, *args):
+        if name not in self.forwarded:
+            return
+        try:
+            frame = encode_frame((EVENT, self.ids[irc], irc.nick, name, args))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logging.warning("Can't forward %s event: %s", name, e)
+            return
+        self.writer.write(frame)
+
+    async def _call(self, call_id, client_id, path, args, kwargs):
+        try:
+            item = self.clients[client_id]
+            for point in path:
+                item = getattr(item, point)
+            result = item(*args, **kwargs)
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                result = await result
+            frame = encode_frame((RESULT, call_id, True, result))
+        except Exception as e:
+            try:
+                frame = encode_frame((RESULT, call_id, False, e))
+            except Exception:
+                frame = encode_frame((RESULT, call_id, False, Exception(repr(e))))
+        self.writer.write(frame)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,191 @@
+"""irc2 line-based asyncio transport"""
+
+import asyncio
+import collections
+import logging
+
+MAX_LINE_LENGTH = 512 + 8191
+
+class LineProtocol(asyncio.Protocol):
+    """
+    LineProtocol splits incoming data into lines as it arrives, instead of
+    resuming a reader coroutine for each line like StreamReader.readline
+    does. Everything received at once is split in one go, and read_lines
+    returns all of the lines received since it was last called.
+
+    Lines longer than max_length (by default 512 bytes, plus 8191 for
+    message tags) are dropped. If more than max_pending lines are waiting to
+    be read, the transport stops reading until they are.
+
+    It also has the parts of the StreamWriter interface that IRCConnection
+    and the ircd use (write, drain, close, write_eof and get_extra_info), so
+    the same object is used in place of both the StreamReader and the
+    StreamWriter:
+
+    >>> protocol = LineProtocol()
+    >>> protocol.data_received(b"PING :a\\r\\nPING")
+    >>> protocol.data_received(b" :b\\r\\n" + b"x" * 9000 + b"\\r\\nPING :c\\r\\n")
+    >>> asyncio.get_event_loop().run_until_complete(protocol.read_lines())
+    [b'PING :a\\r', b'PING :b\\r', b'PING :c\\r']
+
+    Instance variables:
+        transport   the transport, once connected
+        max_length  the longest line accepted, without the newline
+        max_pending the number of unread lines at which reading pauses
+        on_connect  a function to call with the protocol once connected
+    """
+
+    def __init__(self, on_connect=None, max_length=MAX_LINE_LENGTH, max_pending=4096):
+        self.transport = None
+        self.max_length = max_length
+        self.max_pending = max_pending
+        self.on_connect = on_connect
+
+        self.buffer = bytearray()
+        self.discarding = False
+        self.batches = collections.deque()
+        self.pending = 0
+        self.paused = False
+        self.eof = False
+        self.error = None
+        self.read_waiter = None
+
+        self.write_paused = False
+        self.drain_waiters = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def data_received(self, data):
+        buffer = self.buffer
+        end = data.rfind(b"\n")
+        if end < 0:
+            buffer += data
+            if len(buffer) > self.max_length:
+                logging.warning("Dropping line longer than %d bytes", self.max_length)
+                buffer.clear()
+                self.discarding = True
+            return
+
+        if buffer:
+            buffer += data[:end]
+            lines = bytes(buffer).split(b"\n")
+            buffer.clear()
+        else:
+            lines = data[:end].split(b"\n")
+        buffer += data[end + 1:]
+
+        if self.discarding:
+            self.discarding = False
+            del lines[0]
+        if max(map(len, lines), default=0) > self.max_length:
+            logging.warning("Dropping line longer than %d bytes", self.max_length)
+            lines = [line for line in lines if len(line) <= self.max_length]
+        if not lines:
+            return
+
+        self.batches.append(lines)
+        self.pending += len(lines)
+        if self.pending > self.max_pending and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+        self._wake()
+
+    def eof_received(self):
+        self.eof = True
+        self._wake()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.error = exc
+        self._wake()
+
+        error = exc or ConnectionResetError("Connection lost")
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(error)
+        self.drain_waiters = []
+
+    def _wake(self):
+        waiter = self.read_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def read_lines(self):
+        """
+        Wait for lines to be received, and return a list of all of them
+        (without the newline, but with any carriage return). Returns an empty
+        list once the connection is closed.
+        """
+        while not self.batches:
+            if self.error is not None:
+                raise self.error
+            if self.eof:
+                return []
+            self.read_waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self.read_waiter
+            finally:
+                self.read_waiter = None
+
+        if len(self.batches) == 1:
+            lines = self.batches.popleft()
+        else:
+            lines = [line for batch in self.batches for line in batch]
+            self.batches.clear()
+        self.pending = 0
+        if self.paused:
+            self.paused = False
+            self.transport.resume_reading()
+        return lines
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.drain_waiters = []
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        """
+        Wait until the transport's write buffer is below its high-water mark.
+        """
+        if self.transport.is_closing() and self.eof:
+            raise ConnectionResetError("Connection lost")
+        if self.write_paused:
+            waiter = asyncio.get_event_loop().create_future()
+            self.drain_waiters.append(waiter)
+            await waiter
+
+    def write_eof(self):
+        self.transport.write_eof()
+
+    def close(self):
+        self.transport.close()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+def use_uvloop():
+    """
+    Use uvloop's event loop, if it is installed. Returns whether it is.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
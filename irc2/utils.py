@@ -2,12 +2,29 @@
 
 import asyncio
 import collections
+import collections.abc
+import logging
+import string
 import time
 
+casemappings = {
+    "ascii": str.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    "rfc1459": str.maketrans(string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^"),
+    "rfc1459-strict": str.maketrans(string.ascii_uppercase + "[]\\", string.ascii_lowercase + "{}|"),
+}
+uppercases = {name: {lower: upper for upper, lower in table.items()}
+              for name, table in casemappings.items()}
+
 class IStr(str):
     """
-    IStr is a string which follows RFC1459 casing rules, and allows for
-    case-insensitive equality testing.
+    IStr is a string which follows IRC casing rules, and allows for
+    case-insensitive equality testing. The casefolded form of the string is
+    computed once and cached on the instance. The casing rules default to
+    RFC1459 and can be changed with set_casemapping.
+
+    IStrs compare by the process-wide casing rules. IRCClients keep their
+    own casemapping (see IRCClient.fold) for the state they track, since
+    clients on different networks can't share one.
 
     >>> IStr("Hello World") == "HELLO world"
     True
@@ -15,32 +32,105 @@ class IStr(str):
     True
     >>> IStr("Hello World") == "this is a completely different string"
     False
+    >>> IStr("Hello World") != "hello world"
+    False
     """
 
-    case_map = list(zip("[]\\~", "{}|^"))
+    casemapping = "rfc1459"
+    table = casemappings["rfc1459"]
+    upper_table = uppercases["rfc1459"]
+
+    def fold(self):
+        """
+        Get the casefolded form of this string as a plain str.
+        """
+        try:
+            return self._key
+        except AttributeError:
+            self._key = key = str.translate(self, IStr.table)
+            return key
 
     def lower(self):
-        s = str.lower(self)
-        for lo, up in IStr.case_map:
-            s = s.replace(up, lo)
-        return IStr(s)
+        return IStr(self.fold())
 
     def upper(self):
-        s = str.upper(self)
-        for lo, up in IStr.case_map:
-            s = s.replace(lo, up)
-        return IStr(s)
+        """
+        Get the uppercase form of this string under the current casing rules.
+
+        >>> IStr("nick{away}^").upper()
+        'NICK[AWAY]~'
+        """
+        return IStr(str.translate(str.upper(self), IStr.upper_table))
+
+    def __reduce__(self):
+        # the cached key depends on the casemapping, so leave it behind
+        return (IStr, (str(self),))
 
     def __hash__(self):
-        return hash(str(self.lower()))
+        try:
+            return hash(self._key)
+        except AttributeError:
+            return hash(self.fold())
 
     def __eq__(self, other):
-        if not isinstance(other, IStr):
-            other = IStr(other)
+        if isinstance(other, IStr):
+            other = other.fold()
+        elif isinstance(other, str):
+            other = str.translate(other, IStr.table)
+        else:
+            return NotImplemented
+
+        return self.fold() == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+def set_casemapping(name):
+    """
+    Set the process-wide casing rules used by IStr, from the value of a
+    CASEMAPPING ISUPPORT token. Returns False (and leaves the casing rules
+    alone) for unknown casemappings. IStrs which have already been hashed or
+    compared keep their old casefolded form, so this should be called before
+    any IStr is used. IRCClients don't call this: each follows its own
+    server's CASEMAPPING.
+
+    >>> set_casemapping("ascii")
+    True
+    >>> IStr("[") == "{"
+    False
+    >>> IStr("nick{away}").upper()
+    'NICK{AWAY}'
+    >>> set_casemapping("rfc1459")
+    True
+    """
+    if name not in casemappings:
+        return False
+
+    IStr.casemapping = name
+    IStr.table = casemappings[name]
+    IStr.upper_table = uppercases[name]
+    return True
+
+def fold(s, casemapping=None):
+    """
+    Casefold s (an IStr or a plain str) using the given casemapping, or the
+    current casing rules if it is None.
 
-        return str(self.lower()) == str(other.lower())
+    >>> fold("Nick[Away]")
+    'nick{away}'
+    >>> fold("Nick[Away]", "ascii")
+    'nick[away]'
+    """
+    if casemapping is not None and casemapping != IStr.casemapping:
+        return str.translate(s, casemappings[casemapping])
+    if isinstance(s, IStr):
+        return s.fold()
+    return str.translate(s, IStr.table)
 
-class IDict(collections.MutableMapping):
+class IDict(collections.abc.MutableMapping):
     """
     IDict is a dict-like object with case-insensitive keys.
 
@@ -56,17 +146,17 @@ class IDict(collections.MutableMapping):
         self.update(more_data)
 
     def __getitem__(self, key):
-        key, value = self._data[IStr(key).lower()]
+        key, value = self._data[fold(key)]
         return value
 
     def __setitem__(self, key, value):
-        self._data[IStr(key).lower()] = key, value
+        self._data[fold(key)] = key, value
 
     def __delitem__(self, key):
-        del self._data[IStr(key).lower()]
+        del self._data[fold(key)]
 
     def __iter__(self):
-        return (key for key, value in self._data)
+        return (key for key, value in self._data.values())
 
     def __len__(self):
         return len(self._data)
@@ -91,9 +181,10 @@ class IDefaultDict(IDict):
         super().__init__(data, **more_data)
 
     def __getitem__(self, key):
-        if IStr(key).lower() not in self._data:
-            self._data[IStr(key).lower()] = key, self.default()
-        return super().__getitem__(key)
+        folded = fold(key)
+        if folded not in self._data:
+            self._data[folded] = key, self.default()
+        return self._data[folded][1]
 
 def join_max_length(l, sep, maxlen=400):
     """
@@ -106,58 +197,357 @@ def join_max_length(l, sep, maxlen=400):
     ('dolor:sit:amet', [])
     """
 
-    result = ""
     l = list(l)
+    length, count = 0, 0
+    while count < len(l) and length + len(l[count]) < maxlen:
+        length += len(l[count]) + len(sep)
+        count += 1
+    return sep.join(l[:count]), l[count:]
 
-    while l and len(result) + len(l[0]) < maxlen:
-        result += (l.pop(0) + sep)
-    return result[:-len(sep)], l
+def split_text(text, limit):
+    """
+    Split text into chunks whose UTF-8 encoding is at most limit bytes long,
+    splitting at spaces where possible and never inside a UTF-8 sequence.
+    Takes time linear in the length of text. Raises ValueError if limit is
+    less than 4 bytes, which any character fits in.
+
+    >>> list(split_text("lorem ipsum dolor sit amet", 11))
+    ['lorem ipsum', 'dolor sit', 'amet']
+    >>> list(split_text("\u00e9\u00e9\u00e9\u00e9\u00e9", 5)) == ["\u00e9\u00e9", "\u00e9\u00e9", "\u00e9"]
+    True
+    >>> list(split_text("\U0001F600\U0001F600", 4)) == ["\U0001F600", "\U0001F600"]
+    True
+    >>> list(split_text("\U0001F600\U0001F600", 3))
+    Traceback (most recent call last):
+        ...
+    ValueError: Can't split text into chunks of 3 bytes
+    >>> list(split_text("hello", 0))
+    Traceback (most recent call last):
+        ...
+    ValueError: Can't split text into chunks of 0 bytes
+    """
+    if limit < 4:
+        raise ValueError("Can't split text into chunks of {} bytes".format(limit))
+
+    data = text.encode("utf-8")
+    pos, end = 0, len(data)
+
+    while end - pos > limit:
+        cut = data.rfind(b" ", pos, pos + limit + 1)
+        if cut >= pos:
+            if cut > pos:
+                yield data[pos:cut].decode("utf-8")
+            pos = cut + 1
+            continue
+
+        cut = pos + limit
+        while data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        yield data[pos:cut].decode("utf-8")
+        pos = cut
+
+    if pos < end:
+        yield data[pos:].decode("utf-8")
+
+def join_limited(items, sep, limit, maxcount=None):
+    """
+    Join items with sep into strings whose UTF-8 encoding is at most limit
+    bytes long, with at most maxcount items each (or any number if maxcount
+    is None). An item longer than limit gets a string to itself.
+
+    >>> list(join_limited(["#a", "#bb", "#ccc"], ",", 6))
+    ['#a,#bb', '#ccc']
+    >>> list(join_limited(["#a", "#bb", "#ccc"], ",", 100, maxcount=2))
+    ['#a,#bb', '#ccc']
+    """
+    current, size = [], 0
+    seplen = len(sep.encode("utf-8"))
+
+    for item in items:
+        itemlen = len(item.encode("utf-8"))
+        if current and (size + seplen + itemlen > limit or len(current) == maxcount):
+            yield sep.join(current)
+            current, size = [], 0
+
+        size += itemlen + (seplen if current else 0)
+        current.append(item)
+
+    if current:
+        yield sep.join(current)
 
 class TokenBucket(object):
     """
     Implements token-bucket rate limiting with the given bucket size ("fill")
-    and replenishing time (t).
+    and replenishing time (t): the bucket gains one token every t seconds,
+    continuously, measured with a monotonic clock.
+
+    If a parent bucket is given, tokens must be available in both buckets to
+    be taken, so that several buckets can share an overall budget:
+
+    >>> budget = TokenBucket(3, 60)
+    >>> a, b = TokenBucket(2, 60, parent=budget), TokenBucket(2, 60, parent=budget)
+    >>> a.take(), a.take(), b.take(), b.take()
+    (True, True, True, False)
     """
 
-    def __init__(self, fill, t):
+    def __init__(self, fill, t, parent=None):
         self._amount = fill
-        self.last = time.time()
+        self.last = time.monotonic()
 
         self.fill = fill
         self.time = t
+        self.parent = parent
+        self.lock = asyncio.Lock()
 
     def amount(self):
         """
-        Get the current number of tokens in the bucket. Does not decrement the
-        number of tokens (don't use this for rate-limiting).
+        Get the current number of tokens in the bucket, which may be
+        fractional. Does not decrement the number of tokens (don't use this
+        for rate-limiting).
         """
-        old = self._amount
-        self._amount = min(self._amount + ((time.time() - self.last) // self.time), self.fill)
-        if old != self._amount:
-            self.last = time.time()
+        now = time.monotonic()
+        self._amount = min(self._amount + (now - self.last) / self.time, self.fill)
+        self.last = now
 
         return self._amount
 
-    def take(self):
+    def take(self, n=1):
         """
-        Take a token from the bucket, if available. Returns True if successful,
-        and False if not.
+        Take n tokens from the bucket, if available. Returns True if
+        successful, and False if not.
+
+        >>> bucket = TokenBucket(2, 60)
+        >>> bucket.take(), bucket.take(), bucket.take()
+        (True, True, False)
         """
-        if self.amount():
-            self._amount -= 1
+        if self.amount() >= n and (self.parent is None or self.parent.take(n)):
+            self._amount -= n
             return True
         return False
 
-    async def wait(self):
+    def delay(self, n=1):
         """
-        Asynchronously wait for a token to be available in the bucket, then
-        take it. Will complete immediately if a token is already available.
+        Get the number of seconds until n tokens will be available.
         """
-        if self.take():
-            return True
+        delay = max(0, (n - self.amount()) * self.time)
+        if self.parent is not None:
+            delay = max(delay, self.parent.delay(n))
+        return delay
+
+    async def wait(self, n=1):
+        """
+        Asynchronously wait for n tokens to be available in the bucket, then
+        take them. Will complete immediately if they are already available.
+        Concurrent waiters are served in FIFO order, including waiters on
+        other buckets sharing the same parent.
+        """
+        async with self.lock:
+            while self.amount() < n:
+                await asyncio.sleep((n - self._amount) * self.time)
+            if self.parent is not None:
+                await self.parent.wait(n)
+            self.amount()
+            self._amount -= n
+        return True
+
+class SendScheduler(object):
+    """
+    SendScheduler passes queued items to a send function, one per token taken
+    from a TokenBucket. Items with a lower priority number are sent first.
+    Within a priority, destinations take turns, so one busy destination can't
+    starve the others; items for the same destination are sent in order.
+    Destinations are casefolded with the given fold function.
+
+    >>> sent = []
+    >>> scheduler = SendScheduler(TokenBucket(10, 1), lambda *item: sent.append(item))
+    >>> async def main():
+    ...     futures = [scheduler.submit(2, "#a", ("PRIVMSG", "#a", str(n))) for n in range(3)]
+    ...     futures.append(scheduler.submit(2, "#b", ("PRIVMSG", "#b", "hi")))
+    ...     futures.append(scheduler.submit(0, None, ("PONG", "server")))
+    ...     print(scheduler.depth(), scheduler.depth(priority=2), scheduler.depth(dest="#A"))
+    ...     await asyncio.wait(futures)
+    >>> asyncio.get_event_loop().run_until_complete(main())
+    5 4 3
+    >>> [item[-1] for item in sent]
+    ['server', '0', 'hi', '1', '2']
+    """
 
-        await asyncio.sleep(self.time - (time.time() - self.last))
-        return self.take()
+    def __init__(self, bucket, send, fold=fold):
+        self.bucket = bucket
+        self.send = send
+        self.fold = fold
+        self.lanes = collections.defaultdict(collections.OrderedDict)
+        self.queued = 0
+        self.task = None
+
+    def submit(self, priority, dest, item):
+        """
+        Queue item (a tuple of arguments for the send function) with the given
+        priority and destination. Returns a future which completes once the
+        item has been sent.
+        """
+        if dest is not None:
+            dest = self.fold(dest)
+        future = asyncio.get_event_loop().create_future()
+        self.lanes[priority].setdefault(dest, collections.deque()).append((item, future))
+        self.queued += 1
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+        return future
+
+    def depth(self, priority=None, dest=None):
+        """
+        Get the number of queued items, optionally only counting those with
+        the given priority and/or destination.
+        """
+        if priority is None and dest is None:
+            return self.queued
+
+        if dest is not None:
+            dest = self.fold(dest)
+        total = 0
+        for lane_priority, lane in self.lanes.items():
+            if priority is not None and lane_priority != priority:
+                continue
+            for lane_dest, queue in lane.items():
+                if dest is None or lane_dest == dest:
+                    total += len(queue)
+        return total
+
+    def clear(self, error):
+        """
+        Drop every queued item, failing its future with the given exception.
+        """
+        for lane in self.lanes.values():
+            for queue in lane.values():
+                for item, future in queue:
+                    if not future.done():
+                        future.set_exception(error)
+        self.lanes.clear()
+        self.queued = 0
+
+    def _peek(self):
+        """
+        Drop cancelled items from the front of the queues, and return the
+        lane and destination of the next item to send, or None.
+        """
+        for priority in sorted(self.lanes):
+            lane = self.lanes[priority]
+            while lane:
+                dest, queue = next(iter(lane.items()))
+                while queue and queue[0][1].cancelled():
+                    queue.popleft()
+                    self.queued -= 1
+                if queue:
+                    return lane, dest
+                del lane[dest]
+        return None
+
+    def _next(self):
+        head = self._peek()
+        if head is None:
+            return None
+
+        lane, dest = head
+        queue = lane[dest]
+        entry = queue.popleft()
+        self.queued -= 1
+        if queue:
+            lane.move_to_end(dest)
+        else:
+            del lane[dest]
+        return entry
+
+    async def _run(self):
+        # cancelled items are dropped before waiting, so they don't use up
+        # a token
+        while self._peek() is not None:
+            await self.bucket.wait()
+            entry = self._next()
+            if entry is None:
+                return
+
+            item, future = entry
+            try:
+                self.send(*item)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(True)
+
+class KeyedTaskPool(object):
+    """
+    KeyedTaskPool runs coroutines as tasks, with at most "limit" of them in
+    flight at once (or any number, if limit is None). Coroutines submitted with the same key run one after
+    another in submission order, while coroutines with different keys run
+    concurrently. Exceptions raised by the coroutines are logged.
+
+    >>> async def show(n):
+    ...     print(n)
+    >>> async def main():
+    ...     pool = KeyedTaskPool(2)
+    ...     tasks = [await pool.submit("#a", show(n)) for n in range(3)]
+    ...     await asyncio.wait(tasks)
+    >>> asyncio.get_event_loop().run_until_complete(main())
+    0
+    1
+    2
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit) if limit else None
+        self.tails = {}
+        self.in_flight = 0
+
+    async def submit(self, key, coro):
+        """
+        Schedule coro to run after everything previously submitted with the
+        same key. Waits (applying backpressure to the caller) while the pool
+        is full. Returns the task.
+        """
+        if self.semaphore is not None:
+            await self.semaphore.acquire()
+        return self._start(key, self._run(self.tails.get(key), coro), True)
+
+    def submit_nowait(self, key, coro):
+        """
+        Like submit, but return the task right away, without waiting for the
+        pool to have room. The task waits for its turn itself, so callers
+        that mustn't wait (such as a connection's reader) can submit, and
+        keep track of how many of their tasks are pending instead.
+        """
+        return self._start(key, self._run(self.tails.get(key), coro, self.semaphore), False)
+
+    def _start(self, key, coro, release):
+        self.in_flight += 1
+        task = asyncio.ensure_future(coro)
+        self.tails[key] = task
+        task.add_done_callback(lambda task: self._done(key, task, release))
+        return task
+
+    async def _run(self, previous, coro, semaphore=None):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            if semaphore is None:
+                await coro
+            else:
+                async with semaphore:
+                    await coro
+        except asyncio.CancelledError:
+            coro.close()
+            raise
+        except Exception:
+            logging.exception("Unhandled exception in task")
+
+    def _done(self, key, task, release):
+        self.in_flight -= 1
+        if release and self.semaphore is not None:
+            self.semaphore.release()
+        if self.tails.get(key) is task:
+            del self.tails[key]
 
 class AttrGetFollower(object):
     """
@@ -185,7 +575,7 @@ class AttrGetFollower(object):
         return AttrGetFollower(self.path + [attr], self.callback)
 
     def __call__(self, *args, **kwargs):
-        self.callback(self.path, *args, **kwargs)
+        return self.callback(self.path, *args, **kwargs)
 
 if __name__ == '__main__':
     import doctest
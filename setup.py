@@ -11,7 +11,7 @@ setup(
     url="https://github.com/fwilson42/irc2",
     version="0.0.1",
     packages=find_packages(),
-    test_suite='irc2.ircd.test',
+    test_suite='tests',
     setup_requires=setup_requires,
     install_requires=setup_requires,
     classifiers=[
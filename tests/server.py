@@ -0,0 +1,84 @@
+"""Helpers for tests against the bundled irc2.ircd"""
+
+from irc2 import client, connection
+from irc2.ircd import ircd
+from irc2.ircd.channel import channels
+from irc2.ircd.client import clients
+from irc2.ircd.handler import handler
+import asyncio
+import unittest
+
+class IRCdTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    A test case which runs the bundled ircd on a free port for each test,
+    with config (a dict) applied over the default configuration.
+    """
+    config = {}
+    line_protocol = False
+
+    async def asyncSetUp(self):
+        self.saved_config = dict(handler.config)
+        handler.config.update(self.config)
+        self.server = await ircd.start_server("127.0.0.1", 0, self.line_protocol)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.connections = []
+        self.writers = []
+
+    async def asyncTearDown(self):
+        for conn in self.connections:
+            conn.close()
+            if conn.reader_task is not None:
+                await asyncio.wait([conn.reader_task])
+        for writer in self.writers:
+            writer.close()
+        for client in list(clients):
+            client.writer.transport.abort()
+        self.server.close()
+        await asyncio.sleep(0)
+
+        clients.clear()
+        clients.map.clear()
+        channels.clear()
+        handler.config.clear()
+        handler.config.update(self.saved_config)
+
+    async def connect(self, nick):
+        """
+        Open a raw connection and register with the given nick. Returns the
+        StreamReader and StreamWriter once the MOTD has been read.
+        """
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.writers.append(writer)
+        writer.write("NICK {0}\r\nUSER {0} 0 * :{0}\r\n".format(nick).encode())
+        await self.read_until(reader, b" 376 ")
+        return reader, writer
+
+    async def read_until(self, reader, needle, timeout=5):
+        """
+        Read lines until one containing needle, and return the lines read.
+        """
+        lines = []
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line:
+                raise ConnectionError("Connection closed while waiting for {!r}".format(needle))
+            lines.append(line)
+            if needle in line:
+                return lines
+
+    def client(self, **kwargs):
+        """
+        Make an IRCClient for the server, without connecting it.
+        """
+        conn = connection.IRCConnection("127.0.0.1", self.port, ssl=False)
+        self.connections.append(conn)
+        return client.IRCClient(conn, **kwargs)
+
+    async def registered_client(self, nick, **kwargs):
+        """
+        Make an IRCClient, connect it and register with the given nick.
+        """
+        irc = self.client(**kwargs)
+        await irc.irc.connect()
+        await asyncio.wait_for(irc.register(nick, nick, nick), 5)
+        return irc
@@ -0,0 +1,216 @@
+from irc2 import client, connection, parser, utils
+from irc2.ircd.client import clients
+from tests.server import IRCdTestCase
+import asyncio
+import unittest
+
+def make_client():
+    return client.IRCClient(connection.IRCConnection("irc.example.com", 6667, ssl=False))
+
+async def feed(c, *lines):
+    for line in lines:
+        await c._run_handlers(parser.parse_line(line.encode()))
+
+class CasemappingTest(unittest.IsolatedAsyncioTestCase):
+    async def test_clients_follow_their_own_casemapping(self):
+        ascii, rfc1459 = make_client(), make_client()
+        for c, casemapping in ((ascii, "ascii"), (rfc1459, "rfc1459")):
+            c.nick = "me"
+            await feed(c, ":irc.example.com 005 me CASEMAPPING={} :are supported".format(casemapping),
+                       ":me!me@host JOIN #a[b]",
+                       ":me!me@host JOIN #a{b}")
+
+        self.assertEqual(ascii.casemapping, "ascii")
+        self.assertEqual(len(ascii.state.channels), 2)
+        self.assertEqual(rfc1459.casemapping, "rfc1459")
+        self.assertEqual(len(rfc1459.state.channels), 1)
+
+        self.assertEqual(ascii.fold("Nick[A]"), "nick[a]")
+        self.assertEqual(rfc1459.fold("Nick[A]"), "nick{a}")
+
+    async def test_unknown_casemapping_is_ignored(self):
+        c = make_client()
+        await feed(c, ":irc.example.com 005 me CASEMAPPING=unknown :are supported")
+        self.assertEqual(c.casemapping, "rfc1459")
+
+    async def test_reset_forgets_casemapping(self):
+        c = make_client()
+        await feed(c, ":irc.example.com 005 me CASEMAPPING=ascii :are supported")
+        c.reset()
+        self.assertEqual(c.casemapping, "rfc1459")
+
+class DispatchCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cache_only_holds_subscribed_verbs(self):
+        c = make_client()
+        seen = []
+
+        async def on_numeric(message):
+            seen.append(message.verb)
+        c.subscribe(parser.Message(verb="900"), on_numeric)
+
+        await feed(c, *(":irc.example.com {} me :hi".format(n) for n in range(800, 1000)))
+        await feed(c, *("@batch=a :irc.example.com {} me :hi".format(n) for n in range(800, 1000)))
+        if c._handler_task is not None:
+            await c._handler_task
+
+        self.assertEqual(seen, ["900", "900"])
+        self.assertLessEqual(set(c._dispatch_cache), {None} | set(c._verb_subscriptions))
+        self.assertLessEqual(len(c._dispatch_cache), len(c._verb_subscriptions) + 1)
+
+    async def test_unnamed_batch_types_share_an_entry(self):
+        c = make_client()
+        for n in range(50):
+            await feed(c, ":irc.example.com BATCH +b{0} type{0}".format(n),
+                       "@batch=b{0} :nick!u@h PRIVMSG #a :hi".format(n),
+                       ":irc.example.com BATCH -b{0}".format(n))
+        types = {type for _, type in c._batch_dispatch_cache}
+        self.assertLessEqual(types, {None} | c._batch_types)
+
+class SendSchedulerTest(IRCdTestCase):
+    config = {"flood_burst": 100}
+
+    async def test_destinations_take_turns(self):
+        reader, writer = await self.connect("bob")
+        writer.write(b"JOIN #a\r\nJOIN #b\r\n")
+        await self.read_until(reader, b" 366 bob #b ")
+
+        alice = await self.registered_client("alice")
+        alice.scheduler.bucket = utils.TokenBucket(4, 2)
+        await asyncio.gather(*(alice.send("PRIVMSG", target, text) for target, text in
+                               (("#a", "a0"), ("#A", "a1"), ("#a", "a2"), ("#b", "b0"))))
+
+        lines = await self.read_until(reader, b"a2")
+        texts = [line.split(b" :")[-1].strip() for line in lines if b" PRIVMSG " in line]
+        self.assertEqual(texts, [b"a0", b"b0", b"a1", b"a2"])
+
+class LimitsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_max_targets(self):
+        c = make_client()
+        self.assertEqual(c.max_targets("JOIN"), None)
+        self.assertEqual(c.max_targets("PRIVMSG"), 1)
+
+        await feed(c, ":irc.example.com 005 me TARGMAX=PRIVMSG:4,JOIN:,KICK:x :are supported")
+        self.assertEqual(c.max_targets("PRIVMSG"), 4)
+        self.assertEqual(c.max_targets("JOIN"), None)
+        self.assertEqual(c.max_targets("KICK"), 1)
+
+    async def test_say_with_tiny_budget_raises(self):
+        c = make_client()
+        c.hostmask = "me!ident@host"
+        c.features["LINELEN"] = "36"
+        with self.assertRaises(ValueError):
+            await c.say("#channel", "hello")
+
+class RegisterTest(unittest.IsolatedAsyncioTestCase):
+    async def serve(self, caps, sasl_result=None):
+        """
+        Run a server which offers the given capabilities, ACKs whatever is
+        requested, and answers SASL with the given numeric. Returns the port
+        and a future which resolves once the client disconnects.
+        """
+        closed = asyncio.get_running_loop().create_future()
+
+        async def handle(reader, writer):
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                line = parser.parse_line(raw)
+                if line.verb == "CAP" and line.args[0] == "LS":
+                    writer.write(":srv CAP * LS :{}\r\n".format(caps).encode())
+                elif line.verb == "CAP" and line.args[0] == "REQ":
+                    writer.write(":srv CAP * ACK :{}\r\n".format(line.args[1]).encode())
+                elif line.verb == "AUTHENTICATE" and line.args[0] == "PLAIN":
+                    writer.write(b"AUTHENTICATE +\r\n")
+                elif line.verb == "AUTHENTICATE":
+                    writer.write(":srv {} * :SASL result\r\n".format(sasl_result).encode())
+            writer.close()
+            closed.set_result(True)
+
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        return server.sockets[0].getsockname()[1], closed
+
+    async def register(self, port):
+        irc = client.IRCClient(connection.IRCConnection("127.0.0.1", port, ssl=False))
+        irc.scheduler.bucket = utils.TokenBucket(10, 2)
+        await irc.sasl.auth("user", "password")
+        await irc.irc.connect()
+        with self.assertRaises(Exception) as raised:
+            await asyncio.wait_for(irc.register("nick", "ident", "realname"), 5)
+        return irc, str(raised.exception)
+
+    async def test_sasl_not_offered_closes_connection(self):
+        port, closed = await self.serve("multi-prefix")
+        irc, error = await self.register(port)
+        self.assertEqual(error, "SASL not available")
+        self.assertTrue(await asyncio.wait_for(closed, 5))
+
+    async def test_sasl_failure_closes_connection(self):
+        port, closed = await self.serve("sasl", sasl_result="904")
+        irc, error = await self.register(port)
+        self.assertEqual(error, "SASL authentication failed")
+        self.assertTrue(await asyncio.wait_for(closed, 5))
+        await asyncio.wait_for(irc.irc.reader_task, 5)
+        self.assertEqual(irc.irc.waiters, {})
+
+class RegisterWithoutCapTest(IRCdTestCase):
+    async def test_sasl_without_cap_closes_connection(self):
+        irc = self.client()
+        await irc.sasl.auth("user", "password")
+        await irc.irc.connect()
+        with self.assertRaisesRegex(Exception, "SASL not available"):
+            await asyncio.wait_for(irc.register("nick", "ident", "realname"), 5)
+        await asyncio.wait_for(irc.irc.reader_task, 5)
+
+class ReconnectTest(IRCdTestCase):
+    async def test_reset_forgets_identity(self):
+        irc = await self.registered_client("alice")
+        await asyncio.wait_for(irc.join("#a"), 5)
+        self.assertIsNotNone(irc.hostmask)
+
+        irc.reset()
+        self.assertEqual((irc.nick, irc.ident, irc.hostmask), (None, None, None))
+        self.assertEqual(irc.text_budget("PRIVMSG", "#a"),
+                         512 - len(":!xxxxxxxxxx@{} PRIVMSG #a :\r\n".format("x" * 63)))
+
+    async def test_keepalive_goes_through_scheduler(self):
+        irc = self.client()
+        irc.irc.ping_interval = 0.05
+        submitted = []
+        submit = irc.scheduler.submit
+        irc.scheduler.submit = lambda priority, dest, item: (submitted.append((priority, item[0])),
+                                                             submit(priority, dest, item))[1]
+        await irc.irc.connect()
+        await asyncio.wait_for(irc.register("alice", "alice", "alice"), 5)
+
+        while irc.irc.lag is None:
+            await asyncio.sleep(0.05)
+        self.assertIn((0, "PING"), submitted)
+
+    async def test_reconnect_rejoins_channels(self):
+        conf = client.IRCClientConfig("127.0.0.1", self.port, ssl=False)
+        self.connections.append(conf.conn)
+        conf.backoff = 0.2
+        conf.register("alice", "alice", "alice")
+        conf.join("#a")
+        irc = conf.configure()
+        irc.scheduler.bucket = utils.TokenBucket(10, 0.1)
+
+        ready = asyncio.Queue()
+
+        @irc.event.ready
+        async def on_ready():
+            await ready.put(irc.nick)
+
+        self.assertEqual(await asyncio.wait_for(ready.get(), 5), "alice")
+        await asyncio.wait_for(irc.join("#b"), 5)
+
+        clients.map["alice"].evict("Killed")
+        self.assertEqual(await asyncio.wait_for(ready.get(), 10), "alice")
+        conf.reconnect = False
+
+        while irc.state.channel("#b") is None:
+            await asyncio.sleep(0.05)
+        self.assertIsNotNone(irc.state.channel("#a"))
@@ -0,0 +1,158 @@
+from irc2 import connection, parser
+from tests.server import IRCdTestCase
+import asyncio
+import unittest
+
+class WaiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_resolved_waiter_leaves_every_verb_list(self):
+        conn = connection.IRCConnection("irc.example.com", 6667, ssl=False)
+        future = conn.match(parser.Message(verb="PING"), parser.Message(verb="PONG"), parser.Message())
+        await conn.dispatch(parser.parse_line(b":irc.example.com PONG irc.example.com :token"))
+        await asyncio.sleep(0)
+
+        self.assertTrue(future.done())
+        self.assertEqual(conn.waiters, {})
+        self.assertEqual(conn.wildcard_waiters, [])
+
+    async def test_cancelled_waiter_is_forgotten(self):
+        conn = connection.IRCConnection("irc.example.com", 6667, ssl=False)
+        kept = conn.match(verb="PING")
+        conn.match(verb="PING").cancel()
+        await asyncio.sleep(0)
+        self.assertEqual([[future for _, future in waiters] for waiters in conn.waiters.values()], [[kept]])
+
+class ReaderTest(IRCdTestCase):
+    config = {"flood_burst": 100}
+
+    async def test_handler_can_wait_for_join(self):
+        alice = await self.registered_client("alice")
+        bob = await self.registered_client("bob")
+        await asyncio.wait_for(alice.join("#a"), 5)
+        await asyncio.wait_for(bob.join("#a"), 5)
+
+        joined = asyncio.get_running_loop().create_future()
+
+        @bob.event.message
+        async def on_message(message, prefix, target, text):
+            await bob.join("#other")
+            joined.set_result(bob.state.channel("#other"))
+
+        await alice.say("#a", "hello")
+        self.assertIsNotNone(await asyncio.wait_for(joined, 5))
+
+    async def test_state_is_updated_before_waiters_wake(self):
+        alice = await self.registered_client("alice")
+        await asyncio.wait_for(alice.join("#a"), 5)
+        self.assertIsNotNone(alice.state.channel("#a"))
+        self.assertEqual(alice.nick, "alice")
+
+    async def test_concurrent_handler_can_wait_for_join(self):
+        alice = await self.registered_client("alice")
+        bob = await self.registered_client("bob", concurrency=1)
+        await asyncio.wait_for(alice.join("#a"), 5)
+        await asyncio.wait_for(bob.join("#a"), 5)
+
+        joined = asyncio.get_running_loop().create_future()
+
+        @bob.event.message
+        async def on_message(message, prefix, target, text):
+            await bob.join("#other")
+            joined.set_result(True)
+
+        await alice.say("#a", "hello")
+        self.assertTrue(await asyncio.wait_for(joined, 5))
+
+    async def channel_with_bob(self, **kwargs):
+        reader, writer = await self.connect("alice")
+        writer.write(b"JOIN #a\r\n")
+        await self.read_until(reader, b" 366 alice #a ")
+        bob = await self.registered_client("bob", **kwargs)
+        await asyncio.wait_for(bob.join("#a"), 5)
+        return writer, bob
+
+    async def test_slow_handler_pauses_reading(self):
+        writer, bob = await self.channel_with_bob()
+        bob.handler_backlog = 2
+        release = asyncio.Event()
+        texts = []
+
+        @bob.event.message
+        async def on_message(message, prefix, target, text):
+            await release.wait()
+            texts.append(text)
+
+        writer.write(b"".join("PRIVMSG #a :{}\r\n".format(n).encode() for n in range(10)))
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+        self.assertTrue(bob.irc.reading_paused)
+        self.assertEqual(len(bob._handler_queue), 2)
+
+        release.set()
+        for _ in range(100):
+            if len(texts) == 10:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(texts, [str(n) for n in range(10)])
+        self.assertFalse(bob.irc.reading_paused)
+
+    async def test_paused_handler_can_wait_for_join(self):
+        writer, bob = await self.channel_with_bob()
+        bob.handler_backlog = 1
+        texts = []
+
+        @bob.event.message
+        async def on_message(message, prefix, target, text):
+            if text == "first":
+                await bob.join("#other")
+            texts.append(text)
+
+        writer.write(b"PRIVMSG #a :first\r\nPRIVMSG #a :second\r\nPRIVMSG #a :third\r\n")
+        for _ in range(200):
+            if len(texts) == 3:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(texts, ["first", "second", "third"])
+        self.assertIsNotNone(bob.state.channel("#other"))
+
+    async def test_concurrent_handler_can_wait_for_join_during_messages(self):
+        writer, bob = await self.channel_with_bob(concurrency=1)
+        texts = []
+
+        @bob.event.message
+        async def on_message(message, prefix, target, text):
+            if text == "first":
+                await bob.join("#other")
+            texts.append(text)
+
+        writer.write(b"PRIVMSG #a :first\r\nPRIVMSG #a :second\r\n")
+        for _ in range(200):
+            if len(texts) == 2:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(texts, ["first", "second"])
+        self.assertIsNotNone(bob.state.channel("#other"))
+        self.assertEqual(bob.tasks.in_flight, 0)
+
+class DrainTest(IRCdTestCase):
+    async def test_drain_writes_queued_lines(self):
+        reader, writer = await self.connect("alice")
+        conn = connection.IRCConnection("127.0.0.1", self.port, ssl=False)
+        self.connections.append(conn)
+        await conn.connect()
+
+        conn.send("NICK", "bob")
+        conn.send("USER", "bob", "0", "*", "bob")
+        self.assertTrue(conn.outgoing)
+        await conn.drain()
+        self.assertEqual(conn.outgoing, [])
+        self.assertFalse(conn.flush_scheduled)
+        await asyncio.wait_for(conn.match(verb="001"), 5)
+
+    async def test_client_send_is_written_when_it_completes(self):
+        irc = await self.registered_client("alice")
+        writes = []
+        write = irc.irc.writer.write
+        irc.irc.writer.write = lambda data: (writes.append(data), write(data))
+
+        await irc.send("PRIVMSG", "alice", "hello")
+        self.assertEqual(writes, [b"PRIVMSG alice :hello\r\n"])
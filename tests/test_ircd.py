@@ -0,0 +1,165 @@
+from irc2.ircd.channel import Channel, channels
+from irc2.ircd.client import clients
+from irc2.utils import fold
+from tests.server import IRCdTestCase
+import asyncio
+import socket
+import unittest
+
+class SendQTest(IRCdTestCase):
+    config = {"sendq_soft": 4096, "sendq_hard": 64 * 1024,
+              "flood_burst": 10 ** 6, "recvq_max": 1024 * 1024}
+
+    async def slow_connect(self, nick):
+        """
+        Connect and register with small socket buffers on both ends, so that
+        a client which stops reading is noticed quickly.
+        """
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", self.port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        self.writers.append(writer)
+        writer.write("NICK {0}\r\nUSER {0} 0 * :{0}\r\n".format(nick).encode())
+        await self.read_until(reader, b" 376 ")
+        writer.write(b"JOIN #t\r\n")
+        await self.read_until(reader, " 366 {} #t ".format(nick).encode())
+        clients.map[nick].writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        return reader, writer
+
+    async def flood(self, writer, count):
+        for n in range(count):
+            writer.write(b"PRIVMSG #t :" + b"x" * 400 + b"\r\n")
+            if n % 100 == 0:
+                await writer.drain()
+                await asyncio.sleep(0)
+
+    async def test_slow_consumer_is_evicted(self):
+        await self.slow_connect("slow")
+        reader, writer = await self.connect("fast")
+        writer.write(b"JOIN #t\r\n")
+        await self.read_until(reader, b" 366 fast #t ")
+
+        await self.flood(writer, 5000)
+        lines = await self.read_until(reader, b" QUIT ")
+        self.assertIn(b"SendQ exceeded", lines[-1])
+        self.assertNotIn("slow", clients.map)
+        self.assertIn("fast", clients.map)
+
+    async def test_reading_client_is_kept(self):
+        slow_reader, slow_writer = await self.slow_connect("reader")
+        reader, writer = await self.connect("sender")
+        writer.write(b"JOIN #t\r\n")
+        await self.read_until(reader, b" 366 sender #t ")
+
+        for n in range(10):
+            await self.flood(writer, 50)
+            writer.write("PRIVMSG #t :done {}\r\n".format(n).encode())
+            await self.read_until(slow_reader, ":done {}".format(n).encode())
+        self.assertIn("reader", clients.map)
+
+        stats = clients.map["reader"].sendq_stats()
+        self.assertGreater(stats["peak"], 0)
+        self.assertLessEqual(stats["peak"], self.config["sendq_hard"])
+        self.assertEqual(stats["queued"], 0)
+
+class LineProtocolSendQTest(SendQTest):
+    line_protocol = True
+
+class FloodTest(IRCdTestCase):
+    config = {"flood_burst": 10, "flood_rate": 0.05, "recvq_max": 4096}
+
+    async def flood_channel(self):
+        watcher, watcher_writer = await self.connect("watcher")
+        watcher_writer.write(b"JOIN #t\r\n")
+        await self.read_until(watcher, b" 366 watcher #t ")
+        reader, writer = await self.connect("flooder")
+        writer.write(b"JOIN #t\r\n")
+        await self.read_until(reader, b" 366 flooder #t ")
+        await self.read_until(watcher, b" JOIN ")
+        return watcher, writer
+
+    async def receive_flood(self, watcher, writer, count=30):
+        writer.write(b"".join("PRIVMSG #t :{}\r\n".format(n).encode() for n in range(count)))
+        start = asyncio.get_running_loop().time()
+        lines = await self.read_until(watcher, ":{}\r\n".format(count - 1).encode())
+        self.assertEqual([line.split(b" :", 1)[1] for line in lines],
+                         ["{}\r\n".format(n).encode() for n in range(count)])
+        return asyncio.get_running_loop().time() - start
+
+    async def test_flood_is_delayed(self):
+        watcher, writer = await self.flood_channel()
+        elapsed = await self.receive_flood(watcher, writer)
+        self.assertGreater(elapsed, 0.8)
+        self.assertIn("flooder", clients.map)
+
+    async def test_opers_are_exempt(self):
+        watcher, writer = await self.flood_channel()
+        clients.map["flooder"].data["modes"].add("o")
+        elapsed = await self.receive_flood(watcher, writer)
+        self.assertLess(elapsed, 0.5)
+
+    async def test_excess_flood_disconnects(self):
+        watcher, writer = await self.flood_channel()
+        writer.write(b"".join(b"PRIVMSG #t :" + b"x" * 400 + b"\r\n" for n in range(50)))
+        lines = await self.read_until(watcher, b" QUIT ")
+        self.assertIn(b"Excess Flood", lines[-1])
+        self.assertNotIn("flooder", clients.map)
+
+class LineProtocolFloodTest(FloodTest):
+    line_protocol = True
+
+class OperTest(IRCdTestCase):
+    config = {"opers": {"admin": "secret"}}
+
+    async def test_oper(self):
+        reader, writer = await self.connect("alice")
+        writer.write(b"OPER admin wrong\r\n")
+        await self.read_until(reader, b" 464 alice ")
+        self.assertNotIn("o", clients.map["alice"].data["modes"])
+
+        writer.write(b"OPER admin secret\r\n")
+        lines = await self.read_until(reader, b" 381 alice ")
+        self.assertIn(b" MODE alice :+o", lines[0])
+        self.assertIn("o", clients.map["alice"].data["modes"])
+
+class NamesChunksTest(unittest.TestCase):
+    def test_chunks_are_sorted_case_insensitively(self):
+        channel = Channel("#t")
+        nicks = ["{}{}".format("aAbB[{"[n * 7 % 6], n) for n in range(500)]
+        members = {}
+        for nick in nicks:
+            members[nick] = member = object()
+            channel.members[member] = ""
+            channel._insert_nick(member, nick)
+        for nick in nicks[::3]:
+            del channel.members[members[nick]]
+            channel._remove_nick(nick)
+
+        names = b" ".join(line.split(b" :", 1)[1].strip() for line in channel.names())
+        expected = sorted((nick for n, nick in enumerate(nicks) if n % 3), key=fold)
+        self.assertEqual(names.decode().split(" "), expected)
+        self.assertGreater(len(channel.chunks), 1)
+        self.assertTrue(all(len(line) < 512 for line in channel.names()))
+
+class NamesTest(IRCdTestCase):
+    async def join(self, nick):
+        reader, writer = await self.connect(nick)
+        writer.write(b"JOIN #t\r\n")
+        lines = await self.read_until(reader, " 366 {} #t ".format(nick).encode())
+        return reader, writer, lines[-2].split(b" :", 1)[1].split()
+
+    async def test_names(self):
+        await self.join("bob")
+        await self.join("Carol")
+        reader, writer, names = await self.join("alice")
+        self.assertEqual(names, [b"alice", b"@bob", b"Carol"])
+
+        writer.write(b"NICK Dave\r\n")
+        await self.read_until(reader, b" NICK ")
+        writer.write(b"JOIN #t\r\n")
+        lines = await self.read_until(reader, b" 366 Dave #t ")
+        self.assertIn(b" JOIN ", lines[0])
+        self.assertEqual(lines[-2].split(b" :", 1)[1].split(), [b"@bob", b"Carol", b"Dave"])
+        self.assertEqual(len(channels["#t"].members), 3)
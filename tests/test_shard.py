@@ -0,0 +1,52 @@
+from irc2 import shard
+from tests.server import IRCdTestCase
+import asyncio
+
+class ShardedRuntimeTest(IRCdTestCase):
+    config = {"flood_burst": 100}
+
+    async def test_messages_arrive_through_workers(self):
+        runtime = shard.ShardedRuntime(workers=2, stagger=0.01)
+        for nick in ("alice", "bob"):
+            conf = runtime.add("127.0.0.1", self.port, ssl=False)
+            conf.register(nick, nick, nick)
+            conf.join("#a")
+
+        ready = asyncio.Queue()
+        messages = asyncio.Queue()
+
+        @runtime.event.ready
+        async def on_ready(client):
+            await ready.put(client)
+
+        @runtime.event.message
+        async def on_message(client, message, prefix, target, text):
+            await messages.put((client.nick, prefix.nick, target, text))
+
+        await runtime.start()
+        try:
+            for _ in range(2):
+                await asyncio.wait_for(ready.get(), 30)
+            alice, bob = runtime.clients
+            self.assertNotEqual(alice.shard, bob.shard)
+
+            await asyncio.wait_for(alice.say("#a", "hello"), 10)
+            self.assertEqual(await asyncio.wait_for(messages.get(), 10), ("bob", "alice", "#a", "hello"))
+            self.assertEqual(await asyncio.wait_for(bob.line_length(), 10), 512)
+
+            # stop and start forwarding the event again
+            runtime.event.unsubscribe("message", on_message)
+            await asyncio.wait_for(bob.line_length(), 10)
+            runtime.event.subscribe("message", on_message)
+            await asyncio.wait_for(bob.line_length(), 10)
+            await asyncio.wait_for(alice.say("#a", "again"), 10)
+            await asyncio.wait_for(alice.say("#a", "done"), 10)
+            self.assertEqual(await asyncio.wait_for(messages.get(), 10), ("bob", "alice", "#a", "again"))
+            self.assertEqual(await asyncio.wait_for(messages.get(), 10), ("bob", "alice", "#a", "done"))
+        finally:
+            processes, reader_tasks = runtime.processes, runtime.reader_tasks
+            await asyncio.wait_for(runtime.stop(), 10)
+
+        self.assertFalse(any(process.is_alive() for process in processes))
+        self.assertTrue(all(task.done() for task in reader_tasks))
+        self.assertEqual(runtime.processes, [])
@@ -0,0 +1,50 @@
+from irc2 import utils
+import asyncio
+import unittest
+
+class CasemappingTest(unittest.TestCase):
+    def tearDown(self):
+        utils.set_casemapping("rfc1459")
+
+    def test_upper_follows_casemapping(self):
+        self.assertEqual(utils.IStr("nick{away}^").upper(), "NICK[AWAY]~")
+        self.assertEqual(str(utils.IStr("nick{away}^").upper()), "NICK[AWAY]~")
+
+        utils.set_casemapping("ascii")
+        self.assertEqual(str(utils.IStr("nick{away}^").upper()), "NICK{AWAY}^")
+
+        utils.set_casemapping("rfc1459-strict")
+        self.assertEqual(str(utils.IStr("nick{away}^").upper()), "NICK[AWAY]^")
+
+    def test_upper_and_lower_agree(self):
+        for name in utils.casemappings:
+            utils.set_casemapping(name)
+            s = utils.IStr("Nick[Away]{x}|\\~^")
+            self.assertEqual(s.upper().lower(), s.lower())
+
+    def test_fold_with_casemapping(self):
+        self.assertEqual(utils.fold("A[]~", "ascii"), "a[]~")
+        self.assertEqual(utils.fold(utils.IStr("A[]~"), "ascii"), "a[]~")
+        self.assertEqual(utils.fold("A[]~", "rfc1459-strict"), "a{}~")
+        self.assertEqual(utils.fold("A[]~"), "a{}^")
+
+class SendSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_depth_folds_destination(self):
+        scheduler = utils.SendScheduler(utils.TokenBucket(1, 60), lambda *item: None)
+        scheduler.bucket.take()
+        for dest in ("#Chan[1]", "#chan{1}", "#other"):
+            scheduler.submit(2, dest, ("PRIVMSG", dest, "hi"))
+
+        self.assertEqual(scheduler.depth(dest="#CHAN[1]"), 2)
+        self.assertEqual(scheduler.depth(priority=2, dest="#chan{1}"), 2)
+        scheduler.clear(ConnectionError())
+
+    async def test_cancelled_items_do_not_use_tokens(self):
+        sent = []
+        scheduler = utils.SendScheduler(utils.TokenBucket(1, 60), lambda *item: sent.append(item))
+        scheduler.submit(2, "#a", ("PRIVMSG", "#a", "cancelled")).cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.depth(), 0)
+
+        await asyncio.wait_for(scheduler.submit(2, "#a", ("PRIVMSG", "#a", "sent")), 1)
+        self.assertEqual(sent, [("PRIVMSG", "#a", "sent")])